@@ -1,5 +1,7 @@
 from db import *
-from models import *
+from catalog import *
+from recommend import *
+from markets import STOCK_RADIUS_KM, geocode, load_inventory, load_stock_index
 
 import streamlit as st
 from streamlit_extras.let_it_rain import rain
@@ -28,13 +30,15 @@ def login_page():
     if login_button:
         # If correct, change it to main page. Otherwise, warning pops up.
         try:
+            # never cached: the password would sit in the cache key, and other workers' signups would stay unseen
             query_result = select_table("users", where_dict={'user_name': username, 'password': password})
             st.write("<h1 style='text-align:center'>Welcome, {}!</h1>".format(username), unsafe_allow_html=True)
             st.write("<p style='text-align:center'>You have successfully logged in.</p>", unsafe_allow_html=True)
             st.write("<p style='text-align:center'>Enjoy your wine!</p>", unsafe_allow_html=True)
             
             st.session_state['login_flag'] = 'login'
-            st.session_state['profile'] = query_result
+            # embedding updates may still be queued, see init_user_writer
+            st.session_state['profile'] = init_user_writer().apply(query_result)
         except Exception as e:
             st.warning("Incorrect username or password")
 
@@ -74,7 +78,16 @@ def signup_page():
     # Check if the password and confirm password match
     if signup_button:
         try:
-            embeddings = get_initial_vec(model, df_wine, wine_type, bold, tannic, sweet, acidic)
+            wine_catalog = load_catalog(PAGE_COLUMNS['signup'])
+            df_wine = wine_catalog.frame(PAGE_COLUMNS['signup'])
+            df_embedding = wine_catalog.embeddings
+            fingerprint = catalog_initial_vec_fingerprint(wine_catalog.version, df_wine, df_embedding)
+            initial_vec_table = load_initial_vec_table(fingerprint)
+            if initial_vec_table is not None:
+                embeddings = lookup_initial_vec(initial_vec_table, bold, tannic, sweet, acidic)
+            else:
+                embeddings = get_initial_vec(taste_head, df_wine, wine_type, bold, tannic, sweet, acidic,
+                                             df_embedding=df_embedding)
             embeddings = encode_vector(embeddings)
             
             row_dict = {'user_name': name,
@@ -114,8 +127,13 @@ def main_page():
         
     st.subheader(f"{st.session_state['profile']['user_name'][0]}, your current location is {st.session_state['profile']['address'][0]}")
 
-    recommendation = recommend_wine(df_embedding, st.session_state['profile']['embeddings'][0])
-    recommendation_df = df_wine.loc[recommendation.iloc[:200].index]
+    wine_catalog = load_catalog(PAGE_COLUMNS['main'])
+    df_wine = wine_catalog.frame(PAGE_COLUMNS['main'])
+    df_embedding = wine_catalog.embeddings
+    wine_index = load_index(df_embedding, wine_catalog.version)
+
+    recommendation, _ = wine_index.search(st.session_state['profile']['embeddings'][0], k=200)
+    recommendation_df = df_wine.iloc[recommendation]
 
     st.subheader("Top 5 wines of this week")
     with st.container():
@@ -131,23 +149,40 @@ def main_page():
             wine_name = recommendation_df['wine_name'].values[i]
             columns[i].markdown(f"<center>{wine_name}</center>", unsafe_allow_html=True)
 
+    address = st.session_state['profile']['address'][0]
+    st.subheader(f"Wines in stock near {address}")
+    location = geocode(address)
+    if location is None:
+        st.write(f"Stock is not available for {address} yet.")
+    else:
+        stock_index = load_stock_index(load_inventory(), wine_catalog.store)
+        nearby = stock_index.recommend(df_embedding, st.session_state['profile']['embeddings'][0], *location, k=5)
+        if nearby.empty:
+            st.write(f"No wines in stock within {STOCK_RADIUS_KM:g}km.")
+        else:
+            columns = st.columns(5)
+            for i, stocked in enumerate(nearby.itertuples()):
+                wine = df_wine.iloc[stocked.catalog_row]
+                columns[i].markdown(f"<center><img src={wine['url']} style='display: block; width: 100px;'></center>", unsafe_allow_html=True)
+                columns[i].markdown(f"<center>{wine['wine_name']}<br>₩{stocked.price:,} at {stocked.market_name} ({stocked.distance_km:.1f}km)</center>", unsafe_allow_html=True)
+
     st.subheader("Top wine continents you may like.")
     with st.container():
-        recommend_continent = best_continent(recommendation_df, model.encoder.embedding)
+        recommend_continent = best_continent(recommendation_df, wine_vocab)
         columns = st.columns(min(len(recommend_continent), 5))
         for i in range(len(columns)):
             columns[i].markdown(f"{i+1}. {recommend_continent[i]}")
     
     st.subheader("Top grape breeds you may like.")
     with st.container():
-        recommend_grapes = best_grapes(recommendation_df, model.encoder.embedding)
+        recommend_grapes = best_grapes(recommendation_df, wine_vocab)
         columns = st.columns(min(len(recommend_grapes), 5))
         for i in range(len(columns)):
             columns[i].markdown(f"{i+1}. {recommend_grapes[i]}")
             
     st.subheader("Top countries you may like.")
     with st.container():
-        recommend_counties = best_countries(recommendation_df, model.encoder.embedding)
+        recommend_counties = best_countries(recommendation_df, wine_vocab)
         columns = st.columns(min(len(recommend_counties), 5))
         for i in range(len(columns)):
             columns[i].markdown(f"{i+1}. {recommend_counties[i]}")
@@ -165,20 +200,25 @@ def main_page():
 
     if update:
         updated_embeddings = update_my_vec(st.session_state['profile']['embeddings'][0], target_wine_vec, rate)
-        embeddings = encode_vector(updated_embeddings[0])
-        update_log = update_table('users', {'embeddings': embeddings}, {'user_name': st.session_state['profile']['user_name'][0]})
-        st.markdown(update_log)
+        # written behind in batches, the profile reads the queued value meanwhile
+        user_writer = init_user_writer()
+        user_writer.put(st.session_state['profile']['user_name'][0], {'embeddings': updated_embeddings[0]})
+        st.session_state['profile'] = user_writer.apply(st.session_state['profile'])
+        st.markdown(st.session_state['profile'])
         
         # import time
         # time.sleep(5)
         # st.experimental_rerun()
 
 
-model = load_model()
-df_wine = select_table('wines')
-df_embedding = df_wine[['embeddings']].iloc[:, 0].values
-df_embedding = np.stack(df_embedding)
-
+taste_head = load_taste_head()
+if taste_head is None:
+    # no exported taste head yet, serve it from the torch model
+    from models import load_model
+    model = load_model(quantize=st.secrets.get('model', {}).get('quantize'))
+    taste_head, wine_vocab = model, model.encoder.embedding
+else:
+    wine_vocab = taste_head
 st.session_state.setdefault('login_flag', 'logout')
 if st.session_state['login_flag'] == 'logout':
     login_page()
@@ -0,0 +1,212 @@
+""" Micro-benchmarks of the serving paths.
+
+Usage:
+    python benchmark.py encode [--batch-size N] [--repeats N]
+    python benchmark.py quantize [--n-wines N] [--repeats N]
+    python benchmark.py write [--n-rows N] [--batch-size N] [--offline]
+    python benchmark.py recommend [--n-wines N] [--repeats N] [--k N] [--n-probe N ...] [--offline]
+
+--offline runs against a synthetic catalog in an in-memory SQLite database
+instead of Postgres, see fixtures.py.
+"""
+import argparse
+import copy
+import os
+import time
+import numpy as np
+import torch
+
+from catalog import CATALOG_ORDER, CATALOG_TABLE
+from db import SQLite_Backend, encode_vector, insert_table, iter_table, run_statement, set_backend, write_table
+from fixtures import USERS_SCHEMA, load_synthetic_catalog, synthetic_users, synthetic_wines
+from models import QUANTIZED_PATHS, MODEL_PATH, encode_wines, heads_agreement, inference_encoder, load_model
+from recommend import IVF_Index, recommend_batch, recommend_top_k
+
+
+def random_wine_features(embedding, batch_size, seed=0):
+    """ Random but well-formed encoder inputs for `batch_size` wines """
+    generator = torch.Generator().manual_seed(seed)
+    grapes = torch.randint(0, embedding.grapes_size, (batch_size, 8), generator=generator)
+    return {
+        'types': torch.randint(0, embedding.types_size, (batch_size,), generator=generator),
+        'countries': torch.randint(0, embedding.country_size, (batch_size,), generator=generator),
+        'tastes': torch.arange(embedding.tastes_size).repeat(batch_size, 1),
+        'tastes_scales': torch.rand(batch_size, embedding.tastes_size, generator=generator),
+        'aromas': torch.arange(embedding.aroma_size).repeat(batch_size, 1),
+        'aromas_scales': torch.rand(batch_size, embedding.aroma_size, generator=generator),
+        'grapes': grapes,
+        'grapes_scales': torch.rand(batch_size, 8, generator=generator) * (grapes != 0),
+    }
+
+
+def time_per_call(fn, repeats, warmup=10):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def bench_encode(batch_size=1, repeats=200):
+    """ Per-wine encode latency of the training-mode path against the
+    inference paths.
+    """
+    model = load_model()
+    features = random_wine_features(model.encoder.embedding, batch_size)
+
+    baseline = copy.deepcopy(model).train()
+    results = {'train mode + autograd': time_per_call(lambda: baseline.encode(**features), repeats)}
+
+    for backend in [None, 'torchscript']:
+        encoder = inference_encoder(copy.deepcopy(model), backend=backend, example_features=features)
+        name = f"inference ({backend or 'eager'})"
+        results[name] = time_per_call(lambda: encode_wines(encoder, features), repeats)
+
+    print(f"encode, batch size {batch_size}")
+    for name, seconds in results.items():
+        print(f"  {name:<28} {seconds / batch_size * 1e6:10.1f} us/wine")
+    return results
+
+
+def bench_quantize(n_wines=2048, repeats=200):
+    """ Accuracy, size and head latency of the quantized variants against the
+    float model.
+    """
+    model = load_model()
+    features = random_wine_features(model.encoder.embedding, n_wines)
+    embeddings = encode_wines(inference_encoder(model), features)
+
+    def heads(m):
+        with torch.inference_mode():
+            return m.sig(m.taste_regressor(m.common_fc(embeddings[:50])))
+
+    print(f"{'variant':<10} {'size':>9} {'heads (50 rows)':>16} {'taste MAE':>10} {'taste max':>10} {'country':>8}")
+    float_seconds = time_per_call(lambda: heads(model), repeats)
+    print(f"{'float32':<10} {os.path.getsize(MODEL_PATH) / 2**10:7.0f}KB {float_seconds * 1e6:13.1f} us")
+
+    for quantize, path in QUANTIZED_PATHS.items():
+        quantized = load_model(quantize)
+        agreement = heads_agreement(model, quantized, embeddings)
+        seconds = time_per_call(lambda: heads(quantized), repeats)
+        print(f"{quantize:<10} {os.path.getsize(path) / 2**10:7.0f}KB {seconds * 1e6:13.1f} us "
+              f"{agreement['taste_mae']:10.5f} {agreement['taste_max_error']:10.5f} {agreement['country_agreement']:8.2%}")
+
+
+def bench_write(n_rows=2000, batch_size=1000):
+    """ Throughput of per-row insert_table against the batch writer, on a
+    scratch users table that is dropped afterwards.
+    """
+    table_name = 'bench_users'
+    rows = synthetic_users(synthetic_wines(n_rows), n_rows)
+
+    def per_row():
+        for row_dict in rows.to_dict('records'):
+            row_dict['embeddings'] = encode_vector(row_dict['embeddings'])
+            insert_table(table_name, row_dict)
+
+    writers = {
+        'insert_table per row': per_row,
+        'write_table values': lambda: write_table(table_name, rows, batch_size),
+        'write_table copy': lambda: write_table(table_name, rows, batch_size, method='copy'),
+        'write_table values upsert': lambda: write_table(table_name, rows, batch_size, on_conflict=['user_name']),
+        'write_table copy upsert': lambda: write_table(table_name, rows, batch_size, on_conflict=['user_name'], method='copy'),
+    }
+
+    print(f"write {n_rows} users, batch size {batch_size}")
+    run_statement(USERS_SCHEMA.format(table_name=table_name))
+    try:
+        for name, write in writers.items():
+            if 'upsert' not in name:
+                run_statement(f"DELETE FROM {table_name}")
+            start = time.perf_counter()
+            write()
+            seconds = time.perf_counter() - start
+            print(f"  {name:<28} {seconds:8.3f} s {n_rows / seconds:10.0f} rows/s")
+    finally:
+        run_statement(f"DROP TABLE {table_name}")
+
+
+def bench_recommend(repeats=50, k=200, n_probes=None):
+    """ Catalog load time, then per-user top-k latency of the exact scan, one
+    user at a time and batched, against the IVF index, at its default n_probe
+    and over a sweep of n_probe. Each IVF run reports its recall@10 and recall@k against the
+    exact top-k; k defaults to the 200 wines the main page asks for.
+    """
+    start = time.perf_counter()
+    chunks = list(iter_table(CATALOG_TABLE, ['embeddings'], order_by=CATALOG_ORDER, as_numpy=True))
+    matrix = np.concatenate([chunk['embeddings'] for chunk in chunks])
+    print(f"recommend, {len(matrix)} wines loaded and decoded in {time.perf_counter() - start:.2f} s")
+
+    start = time.perf_counter()
+    index = IVF_Index.build(matrix)
+    print(f"  {'IVF build':<28} {time.perf_counter() - start:8.2f} s, {index.n_list} buckets, "
+          f"default n_probe {index.n_probe}")
+
+    users = matrix[np.random.default_rng(0).integers(0, len(matrix), repeats)]
+    queries = iter(np.concatenate([users] * 20))
+    norms = index.norms
+    seconds = time_per_call(lambda: recommend_top_k(matrix, next(queries), k, norms), repeats)
+    print(f"  {'exact top-k':<28} {seconds * 1e3:8.2f} ms/user")
+
+    start = time.perf_counter()
+    _, exact = recommend_batch(matrix, users, k, norms)
+    print(f"  {'exact top-k batch':<28} {(time.perf_counter() - start) / len(users) * 1e3:8.2f} ms/user")
+
+    def recall(n_probe, top):
+        # share of the results within the exact top-k distance, so ties between equal rows do not count as misses
+        return np.mean([np.mean(index.search(user, top, n_probe)[1] <= distances[top - 1] * (1 + 1e-6))
+                        for user, distances in zip(users, exact)])
+
+    if n_probes is None:
+        n_probes = sorted({2**i for i in range(int(np.log2(index.n_list)) + 1)} | {index.n_probe, index.n_list})
+    for n_probe in [None] + list(n_probes):
+        if n_probe is not None:
+            n_probe = min(n_probe, index.n_list)
+            name = f"IVF n_probe={n_probe} ({n_probe / index.n_list:.1%})"
+        else:
+            name = "IVF default n_probe"
+        seconds = time_per_call(lambda: index.search(next(queries), k, n_probe), repeats)
+        print(f"  {name:<28} {seconds * 1e3:8.2f} ms/user, "
+              f"recall@10 {recall(n_probe, min(10, k)):.3f}, recall@{k} {recall(n_probe, k):.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    encode_parser = subparsers.add_parser('encode', help='per-wine encoder latency')
+    encode_parser.add_argument('--batch-size', type=int, default=1)
+    encode_parser.add_argument('--repeats', type=int, default=200)
+
+    quantize_parser = subparsers.add_parser('quantize', help='quantized model accuracy, size and latency')
+    quantize_parser.add_argument('--n-wines', type=int, default=2048)
+    quantize_parser.add_argument('--repeats', type=int, default=200)
+
+    write_parser = subparsers.add_parser('write', help='per-row against batch writes')
+    write_parser.add_argument('--n-rows', type=int, default=2000)
+    write_parser.add_argument('--batch-size', type=int, default=1000)
+    write_parser.add_argument('--offline', action='store_true')
+
+    recommend_parser = subparsers.add_parser('recommend', help='exact against IVF top-k latency and recall')
+    recommend_parser.add_argument('--n-wines', type=int, default=50000, help='synthetic catalog size with --offline')
+    recommend_parser.add_argument('--repeats', type=int, default=50)
+    recommend_parser.add_argument('--k', type=int, default=200)
+    recommend_parser.add_argument('--n-probe', type=int, nargs='+', default=None,
+                                  help='n_probe values to sweep (default: powers of two up to the bucket count)')
+    recommend_parser.add_argument('--offline', action='store_true')
+
+    args = parser.parse_args()
+    if getattr(args, 'offline', False):
+        set_backend(SQLite_Backend())
+        if args.bench == 'recommend':
+            load_synthetic_catalog(n_wines=args.n_wines)
+
+    if args.bench == 'encode':
+        bench_encode(args.batch_size, args.repeats)
+    elif args.bench == 'quantize':
+        bench_quantize(args.n_wines, args.repeats)
+    elif args.bench == 'write':
+        bench_write(args.n_rows, args.batch_size)
+    elif args.bench == 'recommend':
+        bench_recommend(args.repeats, args.k, args.n_probe)
@@ -0,0 +1,47 @@
+""" Offline build of the serving artifacts that sit next to wine_model.pt.
+
+Usage:
+    python build_artifacts.py [--n-list N]
+"""
+import argparse
+
+from catalog import CATALOG_ORDER, CATALOG_TABLE, catalog_columns, load_embedding_store
+from db import select_table, table_version
+from models import export_taste_head, load_model
+from recommend import (INDEX_PATH, INITIAL_VEC_PATH, TASTE_HEAD_PATH, IVF_Index,
+                       build_initial_vec_table, initial_vec_fingerprint)
+
+
+def load_catalog_matrix():
+    store = load_embedding_store(table_version(CATALOG_TABLE))
+    print(f"{len(store.ids)} wines, catalog version {store.version}")
+    df_wine = select_table(CATALOG_TABLE, catalog_columns(), order_by=CATALOG_ORDER)
+    return df_wine, store.matrix
+
+
+def build_index(matrix, n_list=None):
+    index = IVF_Index.build(matrix, n_list=n_list)
+    index.save(INDEX_PATH)
+    print(f"{INDEX_PATH}: {len(matrix)} wines in {index.n_list} buckets")
+
+
+def build_taste_head():
+    export_taste_head(load_model(), TASTE_HEAD_PATH)
+    print(f"{TASTE_HEAD_PATH}: exported")
+
+
+def build_initial_vecs(df_wine, matrix):
+    table = build_initial_vec_table(load_model(), df_wine, initial_vec_fingerprint(df_wine, matrix),
+                                    df_embedding=matrix)
+    print(f"{INITIAL_VEC_PATH}: {table.shape[:-1]} slider combinations, {table.nbytes / 2**20:.1f}MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-list', type=int, default=None, help='number of index buckets (default: sqrt of catalog size)')
+    args = parser.parse_args()
+
+    df_wine, matrix = load_catalog_matrix()
+    build_index(matrix, n_list=args.n_list)
+    build_taste_head()
+    build_initial_vecs(df_wine, matrix)
@@ -0,0 +1,254 @@
+import json
+import os
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+
+from db import iter_table, select_table, table_columns, table_version
+
+
+CATALOG_TABLE = 'wines'
+CATALOG_KEY = 'wine_name'
+# embeddings break ties between equally named wines, so every catalog query sees the same row order
+CATALOG_ORDER = 'wine_name, embeddings'
+
+TASTE_COLUMNS = ['bold', 'tannic', 'sweet', 'acidic']
+GRAPE_COLUMNS = [f'type{i}' for i in range(1, 9)]
+
+# catalog columns each screen reads; anything else is only fetched when asked for
+PAGE_COLUMNS = {
+    'signup': TASTE_COLUMNS,
+    'main': ['url', 'country', 'continent'] + GRAPE_COLUMNS,
+}
+
+CATALOG_SNAPSHOT_PATH = 'wine_catalog.parquet'
+EMBEDDINGS_PATH = 'wine_embeddings.npy'
+EMBEDDINGS_IDS_PATH = 'wine_embeddings.json'
+
+
+class Catalog_Changed(RuntimeError):
+    """ The catalog table no longer matches the Wine_Catalog loading from it """
+
+
+class Embedding_Store:
+    """ Read-only, memory-mapped catalog embedding matrix. Rows follow
+    CATALOG_ORDER; `rows` maps a wine name to its (first) row.
+    """
+    def __init__(self, matrix, ids, version):
+        self.matrix = matrix
+        self.ids = ids
+        self.version = version
+        self.rows = {}
+        for row, wine_name in enumerate(ids):
+            self.rows.setdefault(wine_name, row)
+
+    def row(self, wine_name):
+        return self.rows[wine_name]
+
+
+class Wine_Catalog:
+    """ Column-projected view of the wine catalog, shared by every session.
+
+    Only the wine names are read up front. Other columns are fetched the first
+    time a screen asks for them and then kept, and embeddings come from the
+    memory-mapped Embedding_Store, so the catalog is never pulled with
+    SELECT * nor re-decoded. Rows follow CATALOG_ORDER.
+
+    Loaded columns are persisted to a Parquet snapshot tagged with the catalog
+    version, so a fresh process of the same version reads them from disk
+    instead of Postgres.
+    """
+    def __init__(self, version, snapshot_path=CATALOG_SNAPSHOT_PATH):
+        self.version = version
+        self.snapshot_path = snapshot_path
+        self._lock = threading.Lock()
+        self._store = None
+        self._snapshot_columns = _snapshot_columns(snapshot_path, version)
+        if CATALOG_KEY in self._snapshot_columns:
+            self._frame = _read_snapshot(snapshot_path, [CATALOG_KEY])
+        else:
+            self._frame = select_table(CATALOG_TABLE, [CATALOG_KEY], order_by=CATALOG_ORDER)
+
+    def __len__(self):
+        return len(self._frame)
+
+    def frame(self, columns=()):
+        """ Catalog frame holding at least `columns`, reading missing ones from
+        the snapshot or else fetching them in one query. It also holds every
+        column loaded earlier.
+
+        Args:
+            columns (list, optional): needed columns. Defaults to ().
+
+        Returns:
+            pd.DataFrame: catalog, one row per wine
+        """
+        if all(column in self._frame for column in columns):
+            return self._frame
+
+        with self._lock:
+            missing = [column for column in columns if column not in self._frame]
+            stored = [column for column in missing if column in self._snapshot_columns]
+            queried = [column for column in missing if column not in self._snapshot_columns]
+
+            loaded = {}
+            if stored:
+                snapshot = _read_snapshot(self.snapshot_path, [CATALOG_KEY] + stored)
+                loaded.update(self._checked(snapshot, stored))
+            if queried:
+                result = select_table(CATALOG_TABLE, [CATALOG_KEY] + queried, order_by=CATALOG_ORDER)
+                loaded.update(self._checked(result, queried))
+            if loaded:
+                # swap in a new frame so readers never see a half-assigned one
+                self._frame = self._frame.assign(**loaded)
+            if queried:
+                self._save_snapshot()
+        return self._frame
+
+    def _checked(self, loaded, columns):
+        if not loaded[CATALOG_KEY].equals(self._frame[CATALOG_KEY]):
+            raise Catalog_Changed("wine catalog changed while loading columns")
+        return {column: loaded[column].values for column in columns}
+
+    def _save_snapshot(self):
+        table = pa.Table.from_pandas(self._frame, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'catalog_version': self.version})
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, self.snapshot_path)
+        self._snapshot_columns = set(self._frame.columns)
+
+    @property
+    def store(self):
+        """ Embedding_Store of the catalog version, checked to follow the catalog rows
+
+        Raises:
+            Catalog_Changed: store files were built from another state of the
+                table, under the same lagging version. They are rebuilt first.
+        """
+        store = load_embedding_store(self.version)
+        if store is not self._store:
+            if store.ids != self._frame[CATALOG_KEY].tolist():
+                build_embedding_store(self.version)
+                load_embedding_store.clear()
+                raise Catalog_Changed("wine embeddings do not follow the catalog rows")
+            self._store = store
+        return store
+
+    @property
+    def embeddings(self):
+        return self.store.matrix
+
+
+def load_catalog(columns=()):
+    """ Shared wine catalog of the current catalog version, holding `columns`.
+
+    The version is probed at most every few seconds and lags writes, so the
+    table can change under a catalog before its version does. A catalog whose
+    rows no longer match the table, or whose embedding store no longer matches
+    its rows, is then dropped and loaded again at a freshly probed version.
+
+    Args:
+        columns (list, optional): columns to load, see PAGE_COLUMNS. Defaults to ().
+
+    Returns:
+        Wine_Catalog: catalog holding `columns`
+    """
+    try:
+        catalog = _load_catalog(catalog_version())
+        catalog.frame(columns)
+        catalog.store
+    except Catalog_Changed:
+        catalog_version.clear()
+        _load_catalog.clear()
+        catalog = _load_catalog(catalog_version())
+        catalog.frame(columns)
+        catalog.store
+    return catalog
+
+
+@st.cache_resource(max_entries=1)
+def _load_catalog(version):
+    return Wine_Catalog(version)
+
+
+@st.cache_data(ttl=5)
+def catalog_version():
+    """ Version stamp of the wine catalog, probed at most every few seconds """
+    return table_version(CATALOG_TABLE)
+
+
+@st.cache_data(ttl=60)
+def catalog_columns():
+    """ Catalog columns except the embeddings, which are served by the Embedding_Store """
+    return [column for column in table_columns(CATALOG_TABLE) if column != 'embeddings']
+
+
+def build_embedding_store(version, path=EMBEDDINGS_PATH, ids_path=EMBEDDINGS_IDS_PATH):
+    """ Decode the catalog embeddings once into a float32 .npy matrix with a
+    JSON sidecar of wine names and the catalog version. Files are replaced
+    atomically; the sidecar is written last and marks the matrix as current.
+
+    Args:
+        version (str): catalog version the files are built for
+        path (str, optional): matrix file. Defaults to EMBEDDINGS_PATH.
+        ids_path (str, optional): sidecar file. Defaults to EMBEDDINGS_IDS_PATH.
+    """
+    chunks = list(iter_table(CATALOG_TABLE, [CATALOG_KEY, 'embeddings'], order_by=CATALOG_ORDER, as_numpy=True))
+    ids = [wine_name for chunk in chunks for wine_name in chunk[CATALOG_KEY].tolist()]
+    matrix = np.concatenate([chunk['embeddings'] for chunk in chunks]).astype(np.float32)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, matrix)
+    os.replace(tmp_path, path)
+
+    tmp_path = f"{ids_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': version, 'ids': ids}, f)
+    os.replace(tmp_path, ids_path)
+
+
+@st.cache_resource(max_entries=1)
+def load_embedding_store(version, path=EMBEDDINGS_PATH, ids_path=EMBEDDINGS_IDS_PATH):
+    """ Memory-map the catalog embedding matrix for `version`, rebuilding the
+    files first if they were built for another version. The mapping is shared
+    by every session of the process and its pages by every process.
+
+    Args:
+        version (str): current catalog version, see catalog_version
+        path (str, optional): matrix file. Defaults to EMBEDDINGS_PATH.
+        ids_path (str, optional): sidecar file. Defaults to EMBEDDINGS_IDS_PATH.
+
+    Returns:
+        Embedding_Store: read-only catalog embeddings
+    """
+    stored = _read_sidecar(ids_path)
+    if stored is None or stored['version'] != version or not os.path.exists(path):
+        build_embedding_store(version, path, ids_path)
+        stored = _read_sidecar(ids_path)
+
+    return Embedding_Store(np.load(path, mmap_mode='r'), stored['ids'], version)
+
+
+def _snapshot_columns(snapshot_path, version):
+    """ Columns of the catalog snapshot, empty unless it was saved for `version` """
+    if not os.path.exists(snapshot_path):
+        return set()
+    schema = pq.read_schema(snapshot_path)
+    if (schema.metadata or {}).get(b'catalog_version') != version.encode():
+        return set()
+    return set(schema.names)
+
+
+def _read_snapshot(snapshot_path, columns):
+    return pq.read_table(snapshot_path, columns=columns).to_pandas()
+
+
+def _read_sidecar(ids_path):
+    if not os.path.exists(ids_path):
+        return None
+    with open(ids_path) as f:
+        return json.load(f)
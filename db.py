@@ -1,13 +1,31 @@
 import streamlit as st
+import atexit
 import base64
+import datetime
+import io
+import itertools
+import json
+import logging
+import numbers
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+
+
+logger = logging.getLogger(__name__)
 
 
-@st.cache_resource
 def init_connection():
-    """ Initialize connection. Uses st.cache_resource to only run once
+    """ Open a new database connection
 
     Returns:
         (Connect): database connection
@@ -15,7 +33,942 @@ def init_connection():
     return psycopg2.connect(**st.secrets["postgres"])
 
 
-def select_table(table_name, column_list=None, where_dict=None, order_by=None):
+@st.cache_resource
+def init_pool():
+    """ Initialize the connection pool shared by every session. Uses
+    st.cache_resource to only run once. Sized by the optional [pool] section
+    of secrets.toml (min_size, max_size, timeout, health_check_interval).
+
+    Returns:
+        (Connection_Pool): connection pool
+    """
+    return Connection_Pool(init_connection, **st.secrets.get("pool", {}))
+
+
+class Connection_Pool:
+    """ Bounded, thread-safe pool of database connections.
+
+    Every query checks a connection out for its own duration, so concurrent
+    sessions run on separate connections instead of interleaving on one.
+    Connections idle for longer than `health_check_interval` seconds are
+    pinged before reuse, and broken ones are replaced with new connections.
+    Once one connection turns out broken every idle one is pinged before
+    reuse, so a database restart costs at most the query that found it.
+    """
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30, health_check_interval=30):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_time': 0.0, 'max_wait_time': 0.0,
+                       'timeouts': 0, 'reconnects': 0, 'max_in_use': 0}
+
+        for _ in range(min_size):
+            self._idle.append((self.connect(), time.monotonic()))
+            self._size += 1
+
+    def getconn(self, timeout=None):
+        """ Check a connection out, waiting up to `timeout` seconds when all
+        `max_size` connections are in use.
+
+        Raises:
+            psycopg2.pool.PoolError: If the pool is closed or the wait timed out.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        conn, last_used = None, None
+
+        with self._cond:
+            waited = False
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                waited = True
+                remaining = timeout - (time.monotonic() - start)
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if not self._idle and self._size >= self.max_size:
+                        self._stats['timeouts'] += 1
+                        raise psycopg2.pool.PoolError(f"no connection available within {timeout}s")
+
+            wait_time = time.monotonic() - start
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += wait_time
+                self._stats['max_wait_time'] = max(self._stats['max_wait_time'], wait_time)
+            in_use = self._size - len(self._idle)
+            self._stats['max_in_use'] = max(self._stats['max_in_use'], in_use)
+
+        try:
+            if conn is None:
+                conn = self.connect()
+            elif not self._healthy(conn, last_used):
+                # keep the slot and replace its connection
+                self._close(conn)
+                with self._cond:
+                    self._mark_stale()
+                conn = self.connect()
+                with self._cond:
+                    self._stats['reconnects'] += 1
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, broken=False):
+        """ Return a connection. Broken or closed connections are dropped and
+        replaced lazily by the next checkout.
+        """
+        if not broken and not conn.closed:
+            try:
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+
+        with self._cond:
+            if broken or conn.closed or self._closed:
+                self._size -= 1
+                # the server may have dropped every connection, e.g. on a restart
+                self._mark_stale()
+            else:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+
+        if conn is not None:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """ Check a connection out for the duration of a `with` block. The
+        block runs in a transaction that commits on success and rolls back on
+        error, as `with connection:` does.
+        """
+        conn = self.getconn(timeout)
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            # a connection the server dropped cannot roll back, let the original error through
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def stats(self):
+        """ Pool metrics: size, saturation and checkout wait times
+
+        Returns:
+            dict: pool metrics
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({'size': self._size, 'idle': len(self._idle),
+                          'in_use': self._size - len(self._idle), 'max_size': self.max_size})
+        stats['saturation'] = stats['in_use'] / self.max_size
+        stats['mean_wait_time'] = stats['wait_time'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _mark_stale(self):
+        """ Have every idle connection pinged on its next checkout """
+        self._idle = deque((conn, float('-inf')) for conn, _ in self._idle)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+@st.cache_resource
+def init_backend():
+    """ Initialize the storage backend shared by every session: the embedded
+    SQLite backend when secrets.toml has a [sqlite] section (path), else
+    Postgres through the connection pool.
+
+    Returns:
+        (Postgres_Backend or SQLite_Backend): storage backend
+    """
+    if "sqlite" in st.secrets:
+        return SQLite_Backend(**st.secrets["sqlite"])
+    return Postgres_Backend(init_pool())
+
+
+_backend = None
+
+
+def set_backend(backend):
+    """ Route every query of this process to `backend` instead of the one of
+    init_backend, e.g. an offline SQLite_Backend for benchmarks.
+    """
+    global _backend
+    _backend = backend
+    init_query_cache().clear()
+
+
+def get_backend():
+    """ Storage backend queries run on, see set_backend and init_backend """
+    return _backend if _backend is not None else init_backend()
+
+
+class Postgres_Backend:
+    """ Storage backend on Postgres. Queries run on connections checked out
+    of a Connection_Pool.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+
+    def connection(self, timeout=None):
+        return self.pool.connection(timeout)
+
+    @contextmanager
+    def cursor(self, conn, name=None, itersize=None):
+        """ Cursor on `conn`; named cursors are server-side and stream their rows """
+        with conn.cursor(name=name) as cur:
+            if itersize is not None:
+                cur.itersize = itersize
+            yield cur
+
+    def execute(self, cur, query, values=None):
+        cur.execute(query, values)
+
+    def execute_values(self, cur, query, records):
+        """ Run `query` with its `VALUES %s` expanded to every record in one statement
+
+        Returns:
+            int: number of rows affected
+        """
+        psycopg2.extras.execute_values(cur, query, records, page_size=len(records))
+        return cur.rowcount
+
+    def copy_records(self, cur, table_name, columns_clause, records):
+        buffer = io.StringIO()
+        for record in records:
+            buffer.write(','.join(map(_copy_field, record)))
+            buffer.write('\n')
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table_name} ({columns_clause}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    def create_staging_table(self, cur, table_name, staging_table, columns_clause):
+        # only the batch columns: LIKE would copy NOT NULL constraints without the defaults
+        cur.execute(f"DROP TABLE IF EXISTS pg_temp.{staging_table}")
+        cur.execute(f"CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS "
+                    f"SELECT {columns_clause} FROM {table_name} WITH NO DATA")
+
+    def columns_query(self, table_name):
+        return ("SELECT column_name FROM information_schema.columns "
+                "WHERE table_name = %s ORDER BY ordinal_position"), [table_name]
+
+    def version_query(self, table_name):
+        # Postgres' cumulative insert/update/delete counters lag a committed write by up to 10 seconds
+        return (f"SELECT count(*) AS n_rows, "
+                f"(SELECT n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables WHERE relname = %s) AS n_changes "
+                f"FROM {table_name}"), [table_name]
+
+    def explain_query(self, query):
+        return f"EXPLAIN {query}"
+
+    def stats(self):
+        return self.pool.stats()
+
+
+def _copy_field(value):
+    """ CSV field of a value for COPY FROM. Every value is quoted, so only the
+    unquoted empty field of None reads as NULL; binary values are written in
+    the bytea hex format.
+
+    Raises:
+        TypeError: value with no text form Postgres reads back as the same value
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '"\\x' + bytes(value).hex() + '"'
+    if isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat()
+    elif not isinstance(value, (str, bool, np.bool_, numbers.Real)):
+        raise TypeError(f"can not COPY a value of type {type(value).__name__}: {value!r}")
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+class SQLite_Backend:
+    """ Embedded SQLite storage backend, a stand-in for Postgres to benchmark
+    and load-test without a database server. Embeddings are stored as the same
+    base85 text. Every query shares one connection, so queries are serialized.
+
+    Queries use psycopg2's placeholders (%s, %% for a literal %), translated
+    outside quoted literals. Table versions come from a per-table change
+    counter kept by triggers, which also count writes of other processes to
+    the same file.
+
+    Args:
+        path (str, optional): database file. Defaults to an in-memory database.
+    """
+    # SQLITE_MAX_VARIABLE_NUMBER of SQLite 3.32 and later
+    max_variables = 32766
+    # per-table write counters, see version_query
+    changes_table = 'table_changes'
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """ The shared connection for the duration of a `with` block, run in a
+        transaction that commits on success and rolls back on error.
+        """
+        with self._lock:
+            with self._conn:
+                yield self._conn
+
+    @contextmanager
+    def cursor(self, conn, name=None, itersize=None):
+        cur = conn.cursor()
+        if itersize is not None:
+            cur.arraysize = itersize
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+    def execute(self, cur, query, values=None):
+        # as psycopg2, placeholders are only read when values are given
+        if values is None:
+            cur.execute(query)
+        else:
+            cur.execute(_sqlite_placeholders(query), values)
+
+    def execute_values(self, cur, query, records):
+        """ Run `query` with its `VALUES %s` expanded to the records, in as few
+        statements as the variable limit allows
+
+        Returns:
+            int: number of rows affected
+        """
+        n_columns = len(records[0])
+        rows_per_statement = max(1, self.max_variables // n_columns)
+        row_clause = '(' + ', '.join(['?'] * n_columns) + ')'
+
+        # rowcount is -1 for statements starting with WITH, the change counter is not
+        n_changes = cur.connection.total_changes
+        for start in range(0, len(records), rows_per_statement):
+            chunk = records[start:start + rows_per_statement]
+            values_clause = ', '.join([row_clause] * len(chunk))
+            cur.execute(_sqlite_placeholders(query).replace('VALUES ?', f'VALUES {values_clause}', 1),
+                        [value for record in chunk for value in record])
+        return cur.connection.total_changes - n_changes
+
+    def copy_records(self, cur, table_name, columns_clause, records):
+        # SQLite has no COPY, a prepared statement over every record comes closest
+        values_clause = ', '.join(['?'] * len(records[0]))
+        cur.executemany(f"INSERT INTO {table_name} ({columns_clause}) VALUES ({values_clause})", records)
+
+    def create_staging_table(self, cur, table_name, staging_table, columns_clause):
+        cur.execute(f"DROP TABLE IF EXISTS temp.{staging_table}")
+        cur.execute(f"CREATE TEMP TABLE {staging_table} AS SELECT {columns_clause} FROM {table_name} WHERE 0")
+
+    def columns_query(self, table_name):
+        return "SELECT name AS column_name FROM pragma_table_info(%s) ORDER BY cid", [table_name]
+
+    def version_query(self, table_name):
+        self._track_changes(table_name)
+        return (f"SELECT count(*) AS n_rows, "
+                f"(SELECT n_changes FROM {self.changes_table} WHERE table_name = %s) AS n_changes "
+                f"FROM {table_name}"), [table_name]
+
+    def _track_changes(self, table_name):
+        """ Install the triggers counting the row writes of `table_name`. A
+        table recreated since, which dropped its triggers, gets them back with
+        its counter bumped, as writes went uncounted in between.
+        """
+        events = ['INSERT', 'UPDATE', 'DELETE']
+        triggers = [f"{table_name}_{event.lower()}_changes" for event in events]
+        with self.connection() as conn:
+            installed = conn.execute(f"SELECT count(*) FROM sqlite_master WHERE type = 'trigger' "
+                                     f"AND name IN ({', '.join(['?'] * len(triggers))})", triggers).fetchone()[0]
+            if installed == len(triggers):
+                return
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.changes_table} "
+                         f"(table_name TEXT PRIMARY KEY, n_changes INTEGER NOT NULL DEFAULT 0)")
+            conn.execute(f"INSERT OR IGNORE INTO {self.changes_table} (table_name) VALUES (?)", [table_name])
+            conn.execute(f"UPDATE {self.changes_table} SET n_changes = n_changes + 1 WHERE table_name = ?",
+                         [table_name])
+            for event, trigger in zip(events, triggers):
+                conn.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON {table_name} BEGIN "
+                             f"UPDATE {self.changes_table} SET n_changes = n_changes + 1 "
+                             f"WHERE table_name = '{table_name}'; END")
+
+    def explain_query(self, query):
+        return f"EXPLAIN QUERY PLAN {query}"
+
+    def stats(self):
+        return {}
+
+
+_SQLITE_PLACEHOLDER_TOKENS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|%%|%s")
+
+
+def _sqlite_placeholders(query):
+    """ psycopg2 query with SQLite's ? placeholders. %% is a literal %
+    everywhere, as in psycopg2; %s is a placeholder outside quoted literals
+    and identifiers only.
+    """
+    def token(match):
+        token = match.group(0)
+        if token == '%s':
+            return '?'
+        return token.replace('%%', '%')
+    return _SQLITE_PLACEHOLDER_TOKENS.sub(token, query)
+
+
+@st.cache_resource
+def init_query_log():
+    """ Initialize the query log shared by every session. Tuned by the
+    optional [query_log] section of secrets.toml (slow_threshold, max_slow).
+
+    Returns:
+        (Query_Log): query log
+    """
+    return Query_Log(**st.secrets.get("query_log", {}))
+
+
+def query_template(query):
+    """ Query with its whitespace normalized. Values stay placeholders, so
+    every run of a query shares its template.
+    """
+    return re.sub(r"\s+", " ", query).strip()
+
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, float('inf'))
+QUERY_REPORT_COLUMNS = ['template', 'calls', 'errors', 'slow_calls', 'total_time', 'mean_time', 'p50_time',
+                        'p95_time', 'p99_time', 'max_time', 'decode_time', 'rows', 'bytes', 'histogram', 'plan']
+
+
+class Query_Log:
+    """ Per-template timing of the queries of run_query.
+
+    For every query template it keeps a latency histogram, rows fetched,
+    result bytes and embedding decode time. Queries slower than
+    `slow_threshold` seconds go to a slow log of the last `max_slow` ones, and
+    the first slow run of a template captures its EXPLAIN plan. Plans are
+    captured by one background thread, so the request that ran the slow query
+    does not wait for it, and at most one extra connection is used at a time.
+    Values are never recorded, as they can hold passwords.
+    """
+    def __init__(self, slow_threshold=0.5, max_slow=100):
+        self.slow_threshold = slow_threshold
+        self.max_slow = max_slow
+
+        self._templates = {}
+        self._slow = deque(maxlen=max_slow)
+        self._lock = threading.Lock()
+        self._explains = queue.Queue(maxsize=max_slow)
+        self._explain_thread = None
+
+    def record(self, query, values, query_time, decode_time=0.0, n_rows=0, n_bytes=0, error=None):
+        """ Record one run of `query`
+
+        Args:
+            query (str): query clause
+            values (Sequence): values, only used to EXPLAIN slow queries
+            query_time (float): seconds to execute, fetch and build the result
+            decode_time (float, optional): seconds to decode embeddings. Defaults to 0.0.
+            n_rows (int, optional): rows fetched. Defaults to 0.
+            n_bytes (int, optional): estimated result size in memory. Defaults to 0.
+            error (Exception, optional): exception the query raised. Defaults to None.
+        """
+        template = query_template(query)
+        total_time = query_time + decode_time
+        with self._lock:
+            stats = self._templates.get(template)
+            if stats is None:
+                stats = self._templates[template] = {
+                    'calls': 0, 'errors': 0, 'total_time': 0.0, 'max_time': 0.0, 'decode_time': 0.0,
+                    'rows': 0, 'bytes': 0, 'slow_calls': 0, 'histogram': [0] * len(LATENCY_BUCKETS), 'plan': None}
+            stats['calls'] += 1
+            stats['errors'] += error is not None
+            stats['total_time'] += total_time
+            stats['max_time'] = max(stats['max_time'], total_time)
+            stats['decode_time'] += decode_time
+            stats['rows'] += n_rows
+            stats['bytes'] += n_bytes
+            stats['histogram'][_bucket(total_time)] += 1
+
+            slow = total_time >= self.slow_threshold
+            explain = slow and error is None and stats['plan'] is None
+            if slow:
+                stats['slow_calls'] += 1
+                self._slow.append({'template': template, 'time': time.time(), 'total_time': total_time,
+                                   'decode_time': decode_time, 'rows': n_rows, 'bytes': n_bytes,
+                                   'error': None if error is None else repr(error)})
+            if explain:
+                # claim the plan so concurrent slow runs do not all EXPLAIN
+                stats['plan'] = ''
+
+        if explain:
+            self._queue_explain(stats, query, values)
+
+    def report(self):
+        """ Per-template stats, slowest total time first
+
+        Returns:
+            pd.DataFrame: one row per query template
+        """
+        return pd.DataFrame(self._report_rows(), columns=QUERY_REPORT_COLUMNS)
+
+    def _report_rows(self):
+        with self._lock:
+            templates = {template: dict(stats, histogram=list(stats['histogram']))
+                         for template, stats in self._templates.items()}
+
+        rows = []
+        for template, stats in templates.items():
+            rows.append({
+                'template': template,
+                'calls': stats['calls'],
+                'errors': stats['errors'],
+                'slow_calls': stats['slow_calls'],
+                'total_time': stats['total_time'],
+                'mean_time': stats['total_time'] / stats['calls'],
+                'p50_time': _percentile(stats['histogram'], 0.5),
+                'p95_time': _percentile(stats['histogram'], 0.95),
+                'p99_time': _percentile(stats['histogram'], 0.99),
+                'max_time': stats['max_time'],
+                'decode_time': stats['decode_time'],
+                'rows': stats['rows'],
+                'bytes': stats['bytes'],
+                'histogram': stats['histogram'],
+                'plan': stats['plan'],
+            })
+        return sorted(rows, key=lambda row: row['total_time'], reverse=True)
+
+    def slow_queries(self):
+        """ The last slow queries, newest first """
+        with self._lock:
+            return list(reversed(self._slow))
+
+    def dump(self, path=None, **extra):
+        """ Report as JSON, written to `path` when given
+
+        Args:
+            path (str, optional): output file. Defaults to None.
+            **extra: other sections to include, e.g. pool stats
+
+        Returns:
+            str: JSON report
+        """
+        report = {
+            'generated_at': time.time(),
+            'slow_threshold': self.slow_threshold,
+            'latency_buckets': [str(bound) for bound in LATENCY_BUCKETS],
+            'templates': self._report_rows(),
+            'slow_queries': self.slow_queries(),
+            **extra,
+        }
+        dumped = json.dumps(report, indent=2, default=str)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(dumped)
+        return dumped
+
+    def reset(self):
+        with self._lock:
+            self._templates.clear()
+            self._slow.clear()
+
+    def _queue_explain(self, stats, query, values):
+        with self._lock:
+            if self._explain_thread is None:
+                self._explain_thread = threading.Thread(target=self._run_explains, name='query-log-explain',
+                                                        daemon=True)
+                self._explain_thread.start()
+        try:
+            self._explains.put_nowait((stats, query, values))
+        except queue.Full:
+            # let a later slow run of the template try again
+            with self._lock:
+                stats['plan'] = None
+
+    def _run_explains(self):
+        while True:
+            stats, query, values = self._explains.get()
+            plan = _explain(query, values)
+            with self._lock:
+                stats['plan'] = plan
+
+
+def _bucket(seconds):
+    for bucket, bound in enumerate(LATENCY_BUCKETS):
+        if seconds <= bound:
+            return bucket
+
+
+def _percentile(histogram, q):
+    """ Upper bound of the histogram bucket holding the `q` quantile """
+    target = q * sum(histogram)
+    count = 0
+    for bound, bucket_count in zip(LATENCY_BUCKETS, histogram):
+        count += bucket_count
+        if bucket_count and count >= target:
+            return bound
+    return 0.0
+
+
+def _explain(query, values):
+    try:
+        backend = get_backend()
+        with backend.connection() as conn:
+            with backend.cursor(conn) as cur:
+                backend.execute(cur, backend.explain_query(query), values)
+                return '\n'.join(' '.join(map(str, row)) for row in cur.fetchall())
+    except Exception as e:
+        return f"EXPLAIN failed: {e!r}"
+
+
+@st.cache_resource
+def init_user_writer():
+    """ Initialize the write-behind buffer of users table updates shared by
+    every session. Tuned by the optional [write_behind] section of
+    secrets.toml (flush_interval, batch_size, max_attempts).
+
+    Returns:
+        (Write_Behind): users write-behind buffer
+    """
+    return Write_Behind('users', 'user_name', **st.secrets.get("write_behind", {}))
+
+
+class Write_Behind:
+    """ Coalescing write-behind buffer of row updates for one table.
+
+    `put` only records the update, so callers return immediately. Repeated
+    updates of the same key merge, and a background thread writes them with
+    update_rows every `flush_interval` seconds, as soon as `batch_size` keys are
+    pending, and at interpreter exit. Until then `apply` overlays the pending
+    values on query results, so a user reads back their own writes. Pending
+    updates live in this process only.
+
+    Each group of rows setting the same columns is written on its own, so one
+    failing group does not hold back the others. A failed row is retried on
+    the next flushes, and after `max_attempts` failures it is moved to the
+    dead letters reported by `stats` instead of being retried forever.
+    """
+    def __init__(self, table_name, key, flush_interval=2.0, batch_size=1000, max_attempts=5, max_dead_letters=1000):
+        self.table_name = table_name
+        self.key = key
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+        self._pending = {}
+        self._flushing = {}
+        self._attempts = {}
+        self._dead_letters = deque(maxlen=max_dead_letters)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._stats = {'puts': 0, 'coalesced': 0, 'flushes': 0, 'rows_written': 0, 'failures': 0,
+                       'retried': 0, 'dead_lettered': 0}
+
+        self._thread = threading.Thread(target=self._run, name=f"write_behind_{table_name}", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, key_value, update_dict):
+        """ Queue `update_dict` ({column name: value}) for the row whose key is `key_value` """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"write-behind buffer of {self.table_name} is closed")
+            self._stats['puts'] += 1
+            if key_value in self._pending:
+                self._stats['coalesced'] += 1
+            self._pending.setdefault(key_value, {}).update(update_dict)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def pending(self, key_value):
+        """ Not yet written updates of a row, or None """
+        with self._lock:
+            update_dict = {**self._flushing.get(key_value, {}), **self._pending.get(key_value, {})}
+        return update_dict or None
+
+    def apply(self, query_result):
+        """ Query result of the table with pending updates overlaid
+
+        Args:
+            query_result (pd.DataFrame): rows of the table, with the key column
+
+        Returns:
+            pd.DataFrame: query result as it will read once flushed
+        """
+        keys = query_result[self.key].tolist()
+        pending = {key_value: self.pending(key_value) for key_value in set(keys)}
+        pending = {key_value: update_dict for key_value, update_dict in pending.items() if update_dict}
+        if not pending:
+            return query_result
+
+        query_result = query_result.copy()
+        for column in {column for update_dict in pending.values() for column in update_dict}:
+            if column not in query_result:
+                continue
+            values = query_result[column].tolist()
+            for row, key_value in enumerate(keys):
+                if column in pending.get(key_value, {}):
+                    values[row] = pending[key_value][column]
+            query_result[column] = values
+        return query_result
+
+    def flush(self):
+        """ Write every pending update now
+
+        Returns:
+            int: number of rows written
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+            if not self._flushing:
+                return 0
+
+            # rows updating different columns can not share a statement
+            groups = {}
+            for key_value, update_dict in self._flushing.items():
+                groups.setdefault(tuple(sorted(update_dict)), []).append({self.key: key_value, **update_dict})
+
+            n_rows = 0
+            for rows in groups.values():
+                try:
+                    n_group = update_rows(self.table_name, rows, self.key, batch_size=self.batch_size)
+                except Exception as e:
+                    logger.exception("write-behind flush of %d %s rows failed", len(rows), self.table_name)
+                    self._requeue(rows, e)
+                    continue
+                n_rows += n_group
+                with self._lock:
+                    for row in rows:
+                        self._attempts.pop(row[self.key], None)
+                        del self._flushing[row[self.key]]
+
+            with self._lock:
+                self._stats['flushes'] += 1
+                self._stats['rows_written'] += n_rows
+            return n_rows
+
+    def _requeue(self, rows, error):
+        """ Put the rows of a failed group back in the queue, or in the dead letters once out of attempts """
+        with self._lock:
+            self._stats['failures'] += 1
+            for row in rows:
+                key_value = row[self.key]
+                update_dict = self._flushing.pop(key_value)
+                attempts = self._attempts.get(key_value, 0) + 1
+                if attempts < self.max_attempts:
+                    self._attempts[key_value] = attempts
+                    self._pending[key_value] = {**update_dict, **self._pending.get(key_value, {})}
+                    self._stats['retried'] += 1
+                else:
+                    self._attempts.pop(key_value, None)
+                    self._dead_letters.append({'key': key_value, 'columns': sorted(update_dict),
+                                               'attempts': attempts, 'error': repr(error)})
+                    self._stats['dead_lettered'] += 1
+
+    def stats(self):
+        """ Buffer metrics: queued, coalesced, written and dead-lettered updates
+
+        Returns:
+            dict: buffer metrics
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending) + len(self._flushing)
+            stats['dead_letters'] = list(self._dead_letters)
+        return stats
+
+    def close(self):
+        """ Stop the flush thread and write what is still pending """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if not self._closed:
+                self.flush()
+
+
+@st.cache_resource
+def init_query_cache():
+    """ Initialize the query result cache shared by every session. Sized by
+    the optional [query_cache] section of secrets.toml (max_bytes, ttl).
+
+    Returns:
+        (Query_Cache): query result cache
+    """
+    return Query_Cache(**st.secrets.get("query_cache", {}))
+
+
+class Query_Cache:
+    """ LRU cache of query results, bounded by their size in memory.
+
+    Entries are keyed on the whitespace-normalized query and its values,
+    expire after `ttl` seconds and are dropped whenever one of their tables is
+    written to through this module. Writes of other processes are only seen
+    once entries expire. A result computed while its table was written to is
+    not stored.
+    """
+    def __init__(self, max_bytes=64 * 2**20, ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def cached(self, query, values, tables, run):
+        """ Result of `query`, from the cache or else by calling `run()`
+
+        Args:
+            query (str): query clause
+            values (Sequence): values
+            tables (list): tables the query reads
+            run (Callable): runs the query and returns its pd.DataFrame result
+
+        Returns:
+            pd.DataFrame: query result, a copy the caller may modify
+        """
+        key = (query_template(query), repr(tuple(values)))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires'] <= now:
+                self._drop(key)
+                self._stats['expirations'] += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry['result'].copy()
+            self._stats['misses'] += 1
+            generations = [self._generations.get(table, 0) for table in tables]
+
+        result = run()
+        size = _result_size(result)
+        with self._lock:
+            current = [self._generations.get(table, 0) for table in tables]
+            if current == generations and size <= self.max_bytes:
+                if key in self._entries:
+                    self._drop(key)
+                self._entries[key] = {'result': result, 'tables': tables, 'size': size,
+                                      'expires': time.monotonic() + self.ttl}
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    self._drop(next(iter(self._entries)))
+                    self._stats['evictions'] += 1
+        return result.copy()
+
+    def invalidate(self, table_name):
+        """ Drop every result read from `table_name` """
+        with self._lock:
+            self._generations[table_name] = self._generations.get(table_name, 0) + 1
+            stale = [key for key, entry in self._entries.items() if table_name in entry['tables']]
+            for key in stale:
+                self._drop(key)
+            self._stats['invalidations'] += len(stale)
+
+    def stats(self):
+        """ Cache metrics: hits, misses, evictions and memory use
+
+        Returns:
+            dict: cache metrics
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes})
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _drop(self, key):
+        self._bytes -= self._entries.pop(key)['size']
+
+
+def _result_size(query_result, sample_size=100):
+    """ Estimated size of a query result in memory, measured deeply on an
+    evenly strided sample of at most `sample_size` rows and scaled up
+    """
+    n_rows = len(query_result)
+    if n_rows == 0:
+        return int(query_result.memory_usage(deep=False).sum())
+    sample = query_result.iloc[::max(1, n_rows // sample_size)]
+    size = sample.memory_usage(deep=True, index=False).sum()
+    # decoded embeddings are views whose data memory_usage does not count
+    if 'embeddings' in sample:
+        size += sum(vector.nbytes for vector in sample['embeddings'] if vector is not None)
+    return int(size * n_rows / len(sample)) + int(query_result.index.memory_usage())
+
+
+def select_table(table_name, column_list=None, where_dict=None, order_by=None, cached=False):
     """ Perform query, return its query and columns
 
     Args:
@@ -23,11 +976,96 @@ def select_table(table_name, column_list=None, where_dict=None, order_by=None):
         column_list (list, optional): columns for query. Defaults to None.
         where_dict (dict, optional): {column name: value} Defaults to None.
         order_by (str, optional): ordering strategy. Defaults to None.
+        cached (bool, optional): serve the result from the query cache, see
+            init_query_cache. Meant for hot catalog reads, never for
+            credential lookups, whose values would be kept as cache keys.
+            Defaults to False.
 
     Returns:
         query_result (pd.DataFrame): query result.
     """
+    query, values = select_query(table_name, column_list, where_dict, order_by)
+    if cached:
+        return init_query_cache().cached(query, values, [table_name], lambda: run_query(query, values))
+    query_result = run_query(query, values)
+    return query_result
+
+
+def iter_table(table_name, column_list=None, where_dict=None, order_by=None, chunk_size=10000, as_numpy=False):
+    """ Stream a select in chunks through a server-side cursor, so large
+    tables are read in bounded client memory. Embeddings are decoded per chunk.
+    The connection is held until the iterator is exhausted or closed. The
+    whole scan is recorded in the query log once it ends, as one run_query.
+
+    Args:
+        table_name (str): database table name
+        column_list (list, optional): columns for query. Defaults to None.
+        where_dict (dict, optional): {column name: value} Defaults to None.
+        order_by (str, optional): ordering strategy. Defaults to None.
+        chunk_size (int, optional): rows per chunk. Defaults to 10000.
+        as_numpy (bool, optional): yield {column name: np.array} instead of
+            DataFrames, with embeddings as one (n, dim) matrix. Defaults to False.
+
+    Yields:
+        chunk (pd.DataFrame or dict): up to `chunk_size` rows.
+    """
+    query, values = select_query(table_name, column_list, where_dict, order_by)
+    query_log = init_query_log()
+    # only the time spent in here counts, not the time the caller holds a chunk
+    query_time, decode_time, n_rows, n_bytes, error = 0.0, 0.0, 0, 0, None
+    resumed = time.perf_counter()
+    try:
+        backend = get_backend()
+        with backend.connection() as conn:
+            cursor_name = f"iter_{table_name}_{threading.get_ident()}_{time.monotonic_ns()}"
+            with backend.cursor(conn, name=cursor_name, itersize=chunk_size) as cur:
+                backend.execute(cur, query, values)
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    columns = [desc[0] for desc in cur.description]
+
+                    if not as_numpy:
+                        chunk = pd.DataFrame(rows, columns=columns)
+                        if 'embeddings' in chunk:
+                            decode_start = time.perf_counter()
+                            chunk['embeddings'] = decode_column(chunk['embeddings'])
+                            decode_time += time.perf_counter() - decode_start
+                        chunk_bytes = _result_size(chunk)
+                    else:
+                        chunk = {}
+                        for column, column_values in zip(columns, zip(*rows)):
+                            if column == 'embeddings':
+                                decode_start = time.perf_counter()
+                                chunk[column] = decode_vectors(column_values)
+                                decode_time += time.perf_counter() - decode_start
+                            else:
+                                chunk[column] = np.array(column_values)
+                        chunk_bytes = sum(array.nbytes for array in chunk.values())
+                    n_rows += len(rows)
+                    n_bytes += chunk_bytes
 
+                    query_time += time.perf_counter() - resumed
+                    yield chunk
+                    resumed = time.perf_counter()
+        query_time += time.perf_counter() - resumed
+    except GeneratorExit:
+        # closed early by the caller, not an error
+        raise
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        query_log.record(query, values, query_time - decode_time, decode_time, n_rows, n_bytes, error)
+
+
+def select_query(table_name, column_list=None, where_dict=None, order_by=None):
+    """ Build a select query and its values
+
+    Returns:
+        (str, list): query and values
+    """
     if column_list is None:
         column_clause = "*"
     else:
@@ -44,8 +1082,40 @@ def select_table(table_name, column_list=None, where_dict=None, order_by=None):
     if order_by is not None:
         query += f" ORDER BY {order_by}"
 
+    return query, values
+
+
+def table_columns(table_name):
+    """ Column names of a table, in table order
+
+    Args:
+        table_name (str): database table name
+
+    Returns:
+        list: column names
+    """
+    query, values = get_backend().columns_query(table_name)
     query_result = run_query(query, values)
-    return query_result
+    return query_result['column_name'].tolist()
+
+
+def table_version(table_name):
+    """ Cheap version stamp of a table: its row count plus the backend's write
+    counters (Postgres' cumulative insert/update/delete counters for it), so it
+    changes whenever the table is written to. Inserts and deletes show at
+    once through the row count, but Postgres flushes its counters lazily: a
+    backend that stays connected, as pooled ones do, reports an update up to
+    10 seconds late (its idle stats flush interval).
+
+    Args:
+        table_name (str): database table name
+
+    Returns:
+        str: version stamp
+    """
+    query, values = get_backend().version_query(table_name)
+    query_result = run_query(query, values)
+    return f"{query_result['n_rows'][0]}:{query_result['n_changes'][0]}"
 
 
 def update_table(table_name, update_dict, where_dict):
@@ -66,6 +1136,7 @@ def update_table(table_name, update_dict, where_dict):
     query += " RETURNING *"
     
     query_result = run_query(query, values)
+    init_query_cache().invalidate(table_name)
     return query_result
 
 
@@ -86,9 +1157,131 @@ def insert_table(table_name, row_dict):
     query += " RETURNING *"
 
     query_result = run_query(query, values)
+    init_query_cache().invalidate(table_name)
     return query_result
 
 
+def write_table(table_name, rows, batch_size=1000, on_conflict=None, method='values'):
+    """ Write many rows at once, in place of one insert_table per row.
+    Embeddings given as vectors are encoded a whole batch at a time. The write
+    runs in a single transaction and returns nothing, unlike insert_table.
+
+    Args:
+        table_name (str): database table name
+        rows (pd.DataFrame or Iterable): rows as a DataFrame or {column name: value} dicts
+        batch_size (int, optional): rows per statement. Defaults to 1000.
+        on_conflict (list, optional): key columns of a unique constraint. Rows
+            whose key exists update its other columns instead (upsert). Rows
+            repeating a key within a batch keep the last one. Defaults to None.
+        method (str, optional): 'values' for multi-row INSERT ... VALUES or
+            'copy' for COPY FROM STDIN, faster on large loads. Defaults to 'values'.
+
+    Returns:
+        int: number of rows written
+    """
+    if method not in ('values', 'copy'):
+        raise ValueError(f"Unknown write method: {method}")
+
+    n_rows = 0
+    backend = get_backend()
+    with backend.connection() as conn:
+        with backend.cursor(conn) as cur:
+            staging_table, staging_columns = f"{table_name}_staging", None
+            for batch in _batches(rows, batch_size):
+                if on_conflict is not None:
+                    batch = batch.drop_duplicates(on_conflict, keep='last')
+                columns = list(batch.columns)
+                columns_clause = ', '.join(columns)
+                conflict_clause = _conflict_clause(columns, on_conflict)
+                records = _records(batch)
+
+                if method == 'values':
+                    query = f"INSERT INTO {table_name} ({columns_clause}) VALUES %s{conflict_clause}"
+                    backend.execute_values(cur, query, records)
+                elif on_conflict is None:
+                    backend.copy_records(cur, table_name, columns_clause, records)
+                else:
+                    # COPY can not upsert, so batches go through a staging table first
+                    if columns != staging_columns:
+                        backend.create_staging_table(cur, table_name, staging_table, columns_clause)
+                        staging_columns = columns
+                    backend.copy_records(cur, staging_table, columns_clause, records)
+                    # WHERE true keeps SQLite from reading ON CONFLICT as a join constraint
+                    backend.execute(cur, f"INSERT INTO {table_name} ({columns_clause}) "
+                                         f"SELECT {columns_clause} FROM {staging_table} WHERE true{conflict_clause}")
+                    backend.execute(cur, f"DELETE FROM {staging_table}")
+                n_rows += len(records)
+    init_query_cache().invalidate(table_name)
+    return n_rows
+
+
+def update_rows(table_name, rows, key, batch_size=1000):
+    """ Update many rows at once, in place of one update_table per row. Every
+    row sets the same columns and is matched on `key`; rows without a match
+    are skipped. Vector embeddings are encoded a whole batch at a time.
+
+    Args:
+        table_name (str): database table name
+        rows (pd.DataFrame or Iterable): rows as a DataFrame or {column name: value} dicts
+        key (str): column matching a row to update
+        batch_size (int, optional): rows per statement. Defaults to 1000.
+
+    Returns:
+        int: number of rows updated
+    """
+    n_rows = 0
+    backend = get_backend()
+    with backend.connection() as conn:
+        with backend.cursor(conn) as cur:
+            for batch in _batches(rows, batch_size):
+                batch = batch.drop_duplicates(key, keep='last')
+                columns = list(batch.columns)
+                set_clause = ', '.join([f"{column} = v.{column}" for column in columns if column != key])
+                query = (f"WITH v ({', '.join(columns)}) AS (VALUES %s) "
+                         f"UPDATE {table_name} SET {set_clause} FROM v WHERE {table_name}.{key} = v.{key}")
+                n_rows += backend.execute_values(cur, query, _records(batch))
+    init_query_cache().invalidate(table_name)
+    return n_rows
+
+
+def _batches(rows, batch_size):
+    if isinstance(rows, pd.DataFrame):
+        for start in range(0, len(rows), batch_size):
+            yield rows.iloc[start:start + batch_size]
+        return
+
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        yield pd.DataFrame(batch)
+
+
+def _records(batch):
+    """ Batch rows as tuples of Python values, NaN as None and embeddings encoded """
+    batch = batch.astype(object).where(batch.notna(), None)
+    if 'embeddings' in batch:
+        column = batch['embeddings'].values
+        vectors = [row for row, value in enumerate(column) if value is not None and not isinstance(value, str)]
+        if vectors:
+            column = column.copy()
+            column[vectors] = encode_vectors(np.stack([column[row] for row in vectors]))
+            batch['embeddings'] = column
+    return list(map(tuple, batch.values.tolist()))
+
+
+def _conflict_clause(columns, on_conflict):
+    if on_conflict is None:
+        return ""
+    key_clause = ', '.join(on_conflict)
+    update_columns = [column for column in columns if column not in on_conflict]
+    if not update_columns:
+        return f" ON CONFLICT ({key_clause}) DO NOTHING"
+    update_clause = ', '.join([f"{column} = EXCLUDED.{column}" for column in update_columns])
+    return f" ON CONFLICT ({key_clause}) DO UPDATE SET {update_clause}"
+
+
 def run_query(query, values):
     """ Run query. If exception occurs, then raise exception once again
     to detect query is effective.
@@ -103,21 +1296,47 @@ def run_query(query, values):
     Returns:
         query_result (pd.DataFrame): query result.
     """
+    query_log = init_query_log()
+    start = time.perf_counter()
+    decode_time = 0.0
     try:
-        with init_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, values)
+        backend = get_backend()
+        with backend.connection() as conn:
+            with backend.cursor(conn) as cur:
+                backend.execute(cur, query, values)
                 results = cur.fetchall()
                 columns = [desc[0] for desc in cur.description]
                 query_result = pd.DataFrame(results, columns=columns)
+                query_time = time.perf_counter() - start
                 if 'embeddings' in query_result:
-                    query_result['embeddings'] = query_result['embeddings'].apply(decode_vector)
-            return query_result
+                    decode_start = time.perf_counter()
+                    query_result['embeddings'] = decode_column(query_result['embeddings'])
+                    decode_time = time.perf_counter() - decode_start
+        query_log.record(query, values, query_time, decode_time, len(query_result), _result_size(query_result))
+        return query_result
     except Exception as e:
         # TODO: 예외처리 다양화
+        query_log.record(query, values, time.perf_counter() - start - decode_time, decode_time, error=e)
         raise e
     
 
+def run_statement(query, values=None):
+    """ Run a query that returns no rows, such as DDL
+
+    Args:
+        query (str): query clause
+        values (Sequence, optional): values. Defaults to None.
+
+    Returns:
+        int: number of rows affected
+    """
+    backend = get_backend()
+    with backend.connection() as conn:
+        with backend.cursor(conn) as cur:
+            backend.execute(cur, query, values)
+            return cur.rowcount
+
+
 @st.cache_data
 def decode_vector(string_vec):
     """ Decode serialized vector into real number vector
@@ -142,3 +1361,99 @@ def encode_vector(vector):
     embeddings = np.float32(vector).tobytes()
     embeddings = base64.b85encode(embeddings).decode()
     return embeddings
+
+
+def decode_vectors(serialized, codec=None):
+    """ Decode a whole column of serialized vectors into one contiguous matrix
+    in a single pass. Every vector must have the same length.
+
+    Args:
+        serialized (Sequence): `encode_vectors` output, base85 strings or raw bytes
+        codec (str, optional): 'base85' or 'binary'. Defaults to detecting it
+            from the first value.
+
+    Returns:
+        np.array: (n, dim) float32 matrix
+    """
+    if len(serialized) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    if codec is None:
+        codec = 'base85' if isinstance(serialized[0], str) else 'binary'
+
+    if codec == 'base85':
+        if len(set(map(len, serialized))) > 1:
+            raise ValueError("Vectors of different lengths can not be decoded together")
+        # base85 maps every 4 bytes to 5 characters, so float32 vectors concatenate cleanly
+        buffer = _b85decode(''.join(serialized))
+    elif codec == 'binary':
+        if len(set(map(len, serialized))) > 1:
+            raise ValueError("Vectors of different lengths can not be decoded together")
+        buffer = b''.join(serialized)
+    else:
+        raise ValueError(f"Unknown codec: {codec}")
+    return np.frombuffer(buffer, dtype=np.float32).reshape(len(serialized), -1)
+
+
+def encode_vectors(matrix, codec='base85'):
+    """ Encode every row of a matrix at once, `encode_vector` row by row
+
+    Args:
+        matrix (np.array): (n, dim) real number matrix
+        codec (str, optional): 'base85' strings, as stored today, or 'binary'
+            float32 bytes for bytea columns, 20% smaller. Defaults to 'base85'.
+
+    Returns:
+        list: serialized vectors
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[None]
+    row_size = matrix.shape[1] * 4
+
+    if codec == 'base85':
+        buffer = _b85encode(matrix.tobytes())
+        row_size = row_size // 4 * 5
+    elif codec == 'binary':
+        buffer = matrix.tobytes()
+    else:
+        raise ValueError(f"Unknown codec: {codec}")
+    return [buffer[start:start + row_size] for start in range(0, len(buffer), row_size)]
+
+
+def decode_column(column):
+    """ Decode an embeddings column of a query result. Rows become views into
+    one contiguous matrix; NULLs stay None.
+    """
+    valid = np.flatnonzero(column.notna().values)
+    matrix = decode_vectors(column.values[valid])
+    if len(valid) == len(column):
+        return list(matrix)
+
+    decoded = [None] * len(column)
+    for row, vector in zip(valid, matrix):
+        decoded[row] = vector
+    return decoded
+
+
+# vectorized equivalents of base64.b85encode / b85decode for inputs whose length is a multiple of 4 bytes
+_B85_ALPHABET = np.frombuffer(b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                              b"abcdefghijklmnopqrstuvwxyz!#$%&()*+-;<=>?@^_`{|}~", dtype=np.uint8)
+_B85_DIGITS = np.full(256, 255, dtype=np.uint8)
+_B85_DIGITS[_B85_ALPHABET] = np.arange(85)
+_B85_POWERS = 85 ** np.arange(4, -1, -1, dtype=np.uint64)
+
+
+def _b85encode(buffer):
+    words = np.frombuffer(buffer, dtype='>u4').astype(np.uint64)
+    digits = (words[:, None] // _B85_POWERS) % 85
+    return _B85_ALPHABET[digits].tobytes().decode('ascii')
+
+
+def _b85decode(string):
+    digits = _B85_DIGITS[np.frombuffer(string.encode('ascii'), dtype=np.uint8)]
+    if len(digits) % 5 or (digits == 255).any():
+        raise ValueError("Invalid base85 string")
+    words = digits.reshape(-1, 5).astype(np.uint64) @ _B85_POWERS
+    if (words > 0xFFFFFFFF).any():
+        raise ValueError("base85 overflow")
+    return words.astype('>u4').tobytes()
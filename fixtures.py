@@ -0,0 +1,98 @@
+""" Synthetic wine catalog and users, to benchmark and load-test without the
+production database.
+
+Usage:
+    from db import SQLite_Backend, set_backend
+    from fixtures import load_synthetic_catalog
+
+    set_backend(SQLite_Backend())
+    load_synthetic_catalog(n_wines=50000)
+"""
+import numpy as np
+import pandas as pd
+
+from catalog import GRAPE_COLUMNS, TASTE_COLUMNS
+from db import run_statement, write_table
+
+
+EMBEDDING_DIM = 256
+N_GRAPES = 118
+
+COUNTRY_CONTINENTS = {
+    'Argentina': 'South America', 'Australia': 'Oceania', 'Austria': 'Europe', 'Canada': 'North America',
+    'Chile': 'South America', 'France': 'Europe', 'Germany': 'Europe', 'Hungary': 'Europe',
+    'Israel': 'Asia', 'Italy': 'Europe', 'Moldova': 'Europe', 'New Zealand': 'Oceania',
+    'Portugal': 'Europe', 'Romania': 'Europe', 'South Africa': 'Africa', 'Spain': 'Europe',
+    'United States': 'North America',
+}
+
+WINES_SCHEMA = """CREATE TABLE {table_name} (
+    wine_name TEXT, url TEXT, country TEXT, continent TEXT,
+    bold REAL, tannic REAL, sweet REAL, acidic REAL,
+    {grape_columns},
+    embeddings TEXT)"""
+
+USERS_SCHEMA = """CREATE TABLE {table_name} (
+    user_name TEXT PRIMARY KEY, password TEXT, address TEXT, wine_type TEXT,
+    bold REAL, tannic REAL, sweet REAL, acidic REAL,
+    embeddings TEXT)"""
+
+
+def create_tables(wines_table='wines', users_table='users'):
+    """ (Re)create empty wine catalog and users tables on the current backend """
+    grape_columns = ', '.join([f"{column} INTEGER" for column in GRAPE_COLUMNS])
+    for table_name, schema in [(wines_table, WINES_SCHEMA.format(table_name=wines_table, grape_columns=grape_columns)),
+                               (users_table, USERS_SCHEMA.format(table_name=users_table))]:
+        run_statement(f"DROP TABLE IF EXISTS {table_name}")
+        run_statement(schema)
+
+
+def synthetic_wines(n_wines, dim=EMBEDDING_DIM, seed=0):
+    """ Random but well-formed catalog rows, embeddings as float32 vectors """
+    rng = np.random.default_rng(seed)
+    countries = rng.choice(list(COUNTRY_CONTINENTS), n_wines)
+    # most wines blend a few grapes, the remaining slots are PAD (0)
+    grapes = rng.integers(1, N_GRAPES + 1, (n_wines, len(GRAPE_COLUMNS)))
+    grapes[np.arange(len(GRAPE_COLUMNS)) >= rng.integers(1, 4, (n_wines, 1))] = 0
+
+    wines = pd.DataFrame({
+        'wine_name': [f"Synthetic Wine {i:07d}" for i in range(n_wines)],
+        'url': [f"https://example.com/wines/{i}.png" for i in range(n_wines)],
+        'country': countries,
+        'continent': [COUNTRY_CONTINENTS[country] for country in countries],
+    })
+    for column in TASTE_COLUMNS:
+        wines[column] = np.round(rng.random(n_wines), 1)
+    for i, column in enumerate(GRAPE_COLUMNS):
+        wines[column] = grapes[:, i]
+    wines['embeddings'] = list(rng.normal(size=(n_wines, dim)).astype(np.float32))
+    return wines
+
+
+def synthetic_users(wines, n_users, seed=0):
+    """ Users starting from the embedding of a random catalog wine """
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(wines), n_users)
+    return pd.DataFrame({
+        'user_name': [f"user{i}" for i in range(n_users)],
+        'password': 'password',
+        'address': rng.choice(['쌍암동', '오룡동'], n_users),
+        'wine_type': rng.choice(['Red', 'White'], n_users),
+        **{column: wines[column].values[picks] for column in TASTE_COLUMNS},
+        'embeddings': [wines['embeddings'].values[pick] for pick in picks],
+    })
+
+
+def load_synthetic_catalog(n_wines=10000, n_users=100, dim=EMBEDDING_DIM, seed=0, batch_size=5000):
+    """ Replace the wines and users tables of the current backend, see
+    db.set_backend, with a synthetic catalog and its users.
+
+    Returns:
+        (pd.DataFrame, pd.DataFrame): wines and users as written
+    """
+    wines = synthetic_wines(n_wines, dim, seed)
+    users = synthetic_users(wines, n_users, seed)
+    create_tables()
+    write_table('wines', wines, batch_size)
+    write_table('users', users, batch_size)
+    return wines, users
@@ -0,0 +1,324 @@
+import hashlib
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import toy_markets
+from recommend import recommend_top_k
+
+
+# toy markets around GIST; `rows` are their slices of toy_markets.toy_df
+TOY_MARKETS = [
+    {'market_id': 0, 'market_name': 'MARKET A', 'lat': 35.22115148181801, 'lon': 126.84508234413954,
+     'color': '#A9D0F5', 'rows': (0, 18)},
+    {'market_id': 1, 'market_name': 'MARKET B', 'lat': 35.22359306367261, 'lon': 126.85141562924461,
+     'color': '#81BEF7', 'rows': (18, 48)},
+    {'market_id': 2, 'market_name': 'MARKET C', 'lat': 35.221234713907336, 'lon': 126.8540341090701,
+     'color': '#E3CEF6', 'rows': (48, 63)},
+]
+
+MARKET_COLUMNS = ['market_id', 'market_name', 'lat', 'lon', 'color']
+
+# local geocoding of the addresses users can sign up with (Gwangju, Buk-gu)
+ADDRESS_COORDINATES = {
+    '쌍암동': (35.21935, 126.84720),
+    '오룡동': (35.22896, 126.84318),
+}
+
+EARTH_RADIUS_KM = 6371.0088
+
+STOCK_RADIUS_KM = 3.0
+
+
+class Market_Index:
+    """ Uniform latitude/longitude grid over market locations, for radius and
+    k-nearest queries without scanning every market.
+
+    Markets are sorted by grid cell with an offset per occupied cell, as the
+    IVF index buckets wines. A radius query only measures the markets of the
+    cells overlapping the circle's bounding box; a k-nearest query widens the
+    radius until it holds k markets. Distances are exact haversine km.
+    """
+    def __init__(self, lat, lon, cell_km=1.0):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.cell_km = cell_km
+        mean_lat = np.radians(self.lat.mean()) if len(self.lat) else 0.0
+        self.lat_step = np.degrees(cell_km / EARTH_RADIUS_KM)
+        self.lon_step = self.lat_step / max(np.cos(mean_lat), 1e-6)
+
+        rows = np.floor(self.lat / self.lat_step).astype(np.int64)
+        cols = np.floor(self.lon / self.lon_step).astype(np.int64)
+        self.order = np.lexsort((cols, rows))
+        cells, starts, counts = np.unique(np.stack([rows[self.order], cols[self.order]], axis=1),
+                                          axis=0, return_index=True, return_counts=True)
+        self.cells = {(row, col): (start, start + count)
+                      for (row, col), start, count in zip(cells.tolist(), starts.tolist(), counts.tolist())}
+
+    def __len__(self):
+        return len(self.lat)
+
+    def within(self, lat, lon, radius_km):
+        """ Markets within `radius_km` of a location, nearest first
+
+        Returns:
+            (np.array, np.array): market positions and their distances in km
+        """
+        lat_reach = np.degrees(radius_km / EARTH_RADIUS_KM)
+        lon_reach = lat_reach / max(np.cos(np.radians(lat)), 1e-6)
+        candidates = self._box_candidates(lat - lat_reach, lon - lon_reach, lat + lat_reach, lon + lon_reach)
+        distances = haversine_km(lat, lon, self.lat[candidates], self.lon[candidates])
+        inside = distances <= radius_km
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return candidates[order], distances[order]
+
+    def in_box(self, south, west, north, east):
+        """ Markets inside a latitude/longitude box, such as a map viewport
+
+        Returns:
+            np.array: market positions
+        """
+        candidates = self._box_candidates(south, west, north, east)
+        inside = ((self.lat[candidates] >= south) & (self.lat[candidates] <= north)
+                  & (self.lon[candidates] >= west) & (self.lon[candidates] <= east))
+        return np.sort(candidates[inside])
+
+    def nearest(self, lat, lon, k=5):
+        """ The k markets nearest to a location, nearest first
+
+        Returns:
+            (np.array, np.array): market positions and their distances in km
+        """
+        k = min(k, len(self))
+        radius_km = self.cell_km
+        while True:
+            indices, distances = self.within(lat, lon, radius_km)
+            # a radius reaching half the earth holds every market
+            if len(indices) >= k or radius_km > np.pi * EARTH_RADIUS_KM:
+                return indices[:k], distances[:k]
+            radius_km *= 2
+
+    def _box_candidates(self, south, west, north, east):
+        """ Markets of the grid cells overlapping a box """
+        row_range = range(int(np.floor(south / self.lat_step)), int(np.floor(north / self.lat_step)) + 1)
+        col_range = range(int(np.floor(west / self.lon_step)), int(np.floor(east / self.lon_step)) + 1)
+
+        if len(row_range) * len(col_range) < len(self.cells):
+            spans = [self.cells[(row, col)] for row in row_range for col in col_range if (row, col) in self.cells]
+        else:
+            spans = [span for (row, col), span in self.cells.items() if row in row_range and col in col_range]
+        if not spans:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([self.order[start:end] for start, end in spans])
+
+
+class Market_Inventory:
+    """ Wine stock of every market, indexed both ways.
+
+    `stock` has one row per (market, wine) listing with at least market_id,
+    wine_name and price. Optional columns, such as the online price range
+    (min_price, max_price) or imgurl, type, city and date, are kept and shown
+    by the Map page when present. Listings are sorted once by wine then price, with an
+    offset per wine, so finding every market selling a wine is a dict lookup
+    plus a slice, cheapest first. A second ordering by market serves a
+    market's whole inventory the same way. Listings carry their market's
+    columns (name, coordinates, color).
+    """
+    def __init__(self, markets, stock):
+        self.markets = markets.set_index('market_id', drop=False)
+        self.market_index = Market_Index(markets['lat'].values, markets['lon'].values)
+        stock = stock.merge(markets[MARKET_COLUMNS], on='market_id', how='inner')
+        self.version = _frame_digest(markets, stock)
+
+        codes, names = pd.factorize(stock['wine_name'])
+        order = np.lexsort((stock['price'].values, codes))
+        self._by_wine = stock.iloc[order].reset_index(drop=True)
+        self._wine_codes = {wine_name: code for code, wine_name in enumerate(names)}
+        self._wine_offsets = np.searchsorted(codes[order], np.arange(len(names) + 1))
+
+        order = np.argsort(stock['market_id'].values, kind='stable')
+        self._by_market = stock.iloc[order].reset_index(drop=True)
+        market_ids, starts, counts = np.unique(self._by_market['market_id'].values,
+                                               return_index=True, return_counts=True)
+        self._market_offsets = {market_id: (start, start + count)
+                                for market_id, start, count in zip(market_ids.tolist(), starts, counts)}
+
+    def __len__(self):
+        return len(self._by_wine)
+
+    def wine_names(self):
+        """ Every stocked wine, in order of first listing """
+        return list(self._wine_codes)
+
+    def find(self, wine_name):
+        """ Listings of a wine, cheapest first
+
+        Args:
+            wine_name (str): exact wine name
+
+        Returns:
+            pd.DataFrame: one row per market selling it, empty if none does
+        """
+        code = self._wine_codes.get(wine_name)
+        if code is None:
+            return self._by_wine.iloc[:0]
+        return self._by_wine.iloc[self._wine_offsets[code]:self._wine_offsets[code + 1]]
+
+    def best_price(self, wine_name):
+        """ Cheapest listing of a wine, or None """
+        listings = self.find(wine_name)
+        if listings.empty:
+            return None
+        return listings.iloc[0]
+
+    def markets_within(self, lat, lon, radius_km):
+        """ Markets within `radius_km` of a location, nearest first, with a
+        distance_km column
+        """
+        positions, distances = self.market_index.within(lat, lon, radius_km)
+        return self.markets.iloc[positions].assign(distance_km=distances)
+
+    def markets_in_box(self, south, west, north, east):
+        """ Markets inside a latitude/longitude box, such as a map viewport """
+        return self.markets.iloc[self.market_index.in_box(south, west, north, east)]
+
+    def nearest_markets(self, lat, lon, k=5):
+        """ The k markets nearest to a location, nearest first, with a
+        distance_km column
+        """
+        positions, distances = self.market_index.nearest(lat, lon, k)
+        return self.markets.iloc[positions].assign(distance_km=distances)
+
+    def market_inventory(self, market_id):
+        """ Every listing of a market, in stock order
+
+        Returns:
+            pd.DataFrame: one row per wine of the market
+        """
+        start, end = self._market_offsets.get(market_id, (0, 0))
+        return self._by_market.iloc[start:end]
+
+
+class Stock_Index:
+    """ Market stock joined with the catalog embeddings, for recommendations
+    limited to wines on sale near the user.
+
+    Every listing is mapped once to its catalog embedding row by wine name;
+    listings of wines missing from the catalog are skipped. A query gathers
+    the listings of the markets within the radius through the spatial index,
+    keeps the cheapest listing per wine and ranks only those rows, so its cost
+    follows the stock nearby rather than the catalog size.
+    """
+    def __init__(self, inventory, catalog_rows):
+        self.inventory = inventory
+        listings = inventory._by_market
+        rows = listings['wine_name'].map(catalog_rows)
+        self.rows = rows.fillna(-1).values.astype(np.int64)
+        self.prices = listings['price'].values
+        self.market_ids = listings['market_id'].values
+        self._market_offsets = inventory._market_offsets
+
+    def candidates(self, lat, lon, radius_km=STOCK_RADIUS_KM):
+        """ Catalog rows in stock within `radius_km`, with their cheapest listing
+
+        Returns:
+            (np.array, np.array, np.array): catalog rows, best prices and the
+                market ids selling at that price
+        """
+        positions, _ = self.inventory.market_index.within(lat, lon, radius_km)
+        spans = [self._market_offsets[market_id] for market_id in self.inventory.markets['market_id'].values[positions]
+                 if market_id in self._market_offsets]
+        if not spans:
+            return np.zeros(0, dtype=np.int64), self.prices[:0], self.market_ids[:0]
+
+        listings = np.concatenate([np.arange(start, end) for start, end in spans])
+        listings = listings[self.rows[listings] >= 0]
+        rows, prices = self.rows[listings], self.prices[listings]
+        order = np.lexsort((prices, rows))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = rows[order][1:] != rows[order][:-1]
+        best = listings[order[first]]
+        return self.rows[best], self.prices[best], self.market_ids[best]
+
+    def recommend(self, matrix, vec, lat, lon, radius_km=STOCK_RADIUS_KM, k=10):
+        """ Top-k wines for a user among those in stock within `radius_km`
+
+        Args:
+            matrix (np.array): (n_wines, dim) catalog embedding matrix
+            vec (np.array): user embedding
+            lat (float): user latitude
+            lon (float): user longitude
+            radius_km (float, optional): search radius. Defaults to STOCK_RADIUS_KM.
+            k (int, optional): number of wines. Defaults to 10.
+
+        Returns:
+            pd.DataFrame: catalog_row, distance, price and the market selling
+                at that price (market_id, market_name, lat, lon, color,
+                distance_km), nearest wine first
+        """
+        rows, prices, market_ids = self.candidates(lat, lon, radius_km)
+        top, distances = recommend_top_k(matrix[rows], vec, k)
+
+        recommendation = pd.DataFrame({'catalog_row': rows[top], 'distance': distances,
+                                       'price': prices[top], 'market_id': market_ids[top]})
+        markets = self.inventory.markets.reset_index(drop=True)[MARKET_COLUMNS]
+        recommendation = recommendation.merge(markets, on='market_id', how='left')
+        recommendation['distance_km'] = haversine_km(lat, lon, recommendation['lat'].values,
+                                                     recommendation['lon'].values)
+        return recommendation
+
+
+def toy_inventory():
+    """ Markets and stock of the toy data in toy_markets
+
+    Returns:
+        (pd.DataFrame, pd.DataFrame): markets and stock
+    """
+    toy_df = toy_markets.toy_df.rename(columns={'name': 'wine_name', 'cost': 'price',
+                                                'min_cost': 'min_price', 'max_cost': 'max_price'})
+    markets = pd.DataFrame([{column: market[column] for column in MARKET_COLUMNS} for market in TOY_MARKETS])
+    stock = pd.concat([toy_df.iloc[slice(*market['rows'])].assign(market_id=market['market_id'])
+                       for market in TOY_MARKETS], ignore_index=True)
+    return markets, stock
+
+
+def geocode(address):
+    """ Coordinates of a supported address
+
+    Returns:
+        (float, float): latitude and longitude, or None if the address is unknown
+    """
+    return ADDRESS_COORDINATES.get(address)
+
+
+def haversine_km(lat, lon, lats, lons):
+    """ Great-circle distances in km from one location to many """
+    lat, lon, lats, lons = map(np.radians, (lat, lon, lats, lons))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+@st.cache_resource
+def load_inventory():
+    """ Market inventory shared by every session, indexed once per process """
+    return Market_Inventory(*toy_inventory())
+
+
+def load_stock_index(inventory, store):
+    """ Stock_Index of an inventory against a catalog Embedding_Store, shared
+    by every session until either of them changes
+    """
+    return _load_stock_index(inventory, store, inventory.version, store.version)
+
+
+@st.cache_resource(max_entries=1)
+def _load_stock_index(_inventory, _store, inventory_version, catalog_version):
+    return Stock_Index(_inventory, _store.rows)
+
+
+def _frame_digest(*frames):
+    digest = hashlib.sha1()
+    for frame in frames:
+        digest.update(pd.util.hash_pandas_object(frame, index=False).values.tobytes())
+    return digest.hexdigest()[:16]
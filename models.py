@@ -1,6 +1,7 @@
+import logging
 import math
-import random
-from collections import Counter
+import os
+import time
 import pandas as pd
 import numpy as np
 import streamlit as st
@@ -12,19 +13,116 @@ import torch.nn.functional as F
 from torch.nn.parameter import Parameter
 from torch.nn.modules.module import Module
 
+from recommend import MODEL_PATH, TASTE_HEAD_PATH, model_digest, save_npz
+# serving helpers live in the torch-free recommend module
+from recommend import (best_continent, best_countries, best_grapes, get_initial_vec,
+                       recommend_wine, update_my_vec)
+
+
+# dynamically quantized serving variants of wine_model.pt
+QUANTIZED_DTYPES = {'int8': torch.qint8, 'float16': torch.float16}
+QUANTIZED_PATHS = {'int8': 'wine_model.int8.pt', 'float16': 'wine_model.float16.pt'}
+
+
+logger = logging.getLogger(__name__)
+
+# seconds spent in load_model per loaded artifact, a startup metric
+load_stats = {}
+
 
 @st.cache_resource
-def load_model():
+def load_model(quantize=None):
+    """ Load the wine model for serving.
+
+    The float checkpoint is memory-mapped with the weights-only unpickler and
+    the model adopts the mapped tensors, so processes serving the same file
+    share its pages instead of each holding a copy.
+
+    Args:
+        quantize (str, optional): None for the float model, or 'int8' / 'float16'
+            for a dynamically quantized copy of its Linear layers. The quantized
+            weights are cached next to wine_model.pt, tagged with its digest,
+            and rebuilt when it changes.
+
+    Returns:
+        Trainer: model in eval mode
+    """
+    start = time.perf_counter()
+    if quantize is None:
+        path = MODEL_PATH
+        # adopt the mapped tensors instead of copying them into fresh parameters
+        model = build_model()
+        model.load_state_dict(load_checkpoint(path), assign=True)
+    else:
+        path = QUANTIZED_PATHS[quantize]
+        model = build_model()
+        digest = model_digest(MODEL_PATH)
+        saved = load_checkpoint(path) if os.path.exists(path) else None
+        if saved is not None and saved.get('model_digest') == digest:
+            model = quantize_model(model, quantize)
+            model.load_state_dict(saved['state_dict'])
+        else:
+            model.load_state_dict(load_checkpoint(MODEL_PATH))
+            model = quantize_model(model, quantize)
+            # written aside then renamed, so workers starting together never map a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.save({'model_digest': digest, 'state_dict': model.state_dict()}, tmp_path)
+            os.replace(tmp_path, path)
+    model.eval()
+    
+    load_stats[path] = time.perf_counter() - start
+    logger.info("loaded %s in %.1f ms", path, load_stats[path] * 1000)
+    return model
+
+
+def load_checkpoint(path):
+    """ Memory-map a checkpoint with the weights-only (no arbitrary code) unpickler """
+    return torch.load(path, mmap=True, weights_only=True)
+
+
+def build_model():
     embedding = Wine_Embedding(embed_size=32)
     encoder = Att_Encoder(embedding=embedding, x_dim=32, y_dim=256, dropout=0.15)
     model = Trainer(encoder, embed_size=32)
-    model.load_state_dict(torch.load('wine_model.pt'))
     return model
 
 
+def quantize_model(model, quantize):
+    """ Dynamically quantize every Linear layer to `quantize` ('int8' or
+    'float16'). Embedding tables are small and stay in float32.
+    """
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {nn.Linear}, dtype=QUANTIZED_DTYPES[quantize])
+
+
+def heads_agreement(model, other, embeddings):
+    """ Compare the taste and country heads of two models on wine embeddings.
+
+    Args:
+        model (Trainer): reference model
+        other (Trainer): model to check, e.g. a quantized copy
+        embeddings (np.array): (n_wines, 256) wine embeddings
+
+    Returns:
+        dict: taste mean/max absolute error and country top-1 agreement
+    """
+    x = torch.as_tensor(np.asarray(embeddings, dtype=np.float32))
+    with torch.inference_mode():
+        y, y_other = model.activation(model.common_fc(x)), other.activation(other.common_fc(x))
+        tastes = model.sig(model.taste_regressor(y))
+        tastes_other = other.sig(other.taste_regressor(y_other))
+        countries = model.country_classifier(y).argmax(dim=1)
+        countries_other = other.country_classifier(y_other).argmax(dim=1)
+    
+    taste_error = (tastes - tastes_other).abs()
+    return {'taste_mae': taste_error.mean().item(),
+            'taste_max_error': taste_error.max().item(),
+            'country_agreement': (countries == countries_other).float().mean().item()}
+
+
 class GELU(nn.Module):
     def forward(self, x):
-        return 0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
+        # fused kernel of 0.5 * x * (1 + tanh(sqrt(2 / pi) * (x + 0.044715 * x^3)))
+        return F.gelu(x, approximate='tanh')
 
 
 class Wine_Embedding(nn.Module):
@@ -129,10 +227,14 @@ class Att_Encoder(nn.Module):
         query = self.query_fc(x) # Q
         value = self.value_fc(x) # V
         
-        scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(query.size(-1))
-        att = self.softmax(scores)
+        if self.training:
+            scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(query.size(-1))
+            att = self.softmax(scores)
+            y = torch.matmul(att, value)
+        else:
+            # fused attention for serving, same result as the explicit path above
+            y = F.scaled_dot_product_attention(query, key, value)
         
-        y = torch.matmul(att, value)
         y = self.layer_norm(y) + value
         y = self.dropout(y)
         
@@ -174,39 +276,43 @@ class Trainer(nn.Module):
         self.grape_classifier = nn.Linear(self.hidden_dim, embed_size)
         
     def get_grapes(self, y_grape, grapes=None, grapes_scales=None):
-        embedding_matrix = self.encoder.embedding.grapes_embedding.weight.clone()
-        final_pred_y = []
-        true_y = []
-        
+        embedding_matrix = self.encoder.embedding.grapes_embedding.weight
         pred_y = torch.matmul(y_grape, embedding_matrix.T)
         
-        for i in range(pred_y.shape[0]):
-            final_pred_y.append(pred_y[i][grapes[i][grapes[i]!=0]])
-            true_y.append(grapes_scales[i][grapes_scales[i]!=0])
-            
-        final_pred_y = self.sig(torch.cat(final_pred_y))
-        true_y = torch.cat(true_y)
+        # scores of each row's non-padding grapes, flattened row by row
+        final_pred_y = self.sig(pred_y.gather(1, grapes)[grapes != 0])
+        true_y = grapes_scales[grapes_scales != 0]
         
         return final_pred_y, true_y
         
     def get_aromas(self, y_aromas, aromas=None, aromas_scales=None):
-        embedding_matrix = self.encoder.embedding.aroma_embedding.weight.clone()
-        
-        final_pred_y = []
-        true_y = []
-        
-        pred_y = torch.matmul(y_aromas,embedding_matrix.T)
+        embedding_matrix = self.encoder.embedding.aroma_embedding.weight
+        pred_y = torch.matmul(y_aromas, embedding_matrix.T)
         
-        for i in range(pred_y.shape[0]):
-            aromas_id = aromas[i][aromas_scales[i]!=0] 
-            final_pred_y.append(pred_y[i][aromas_id])
-            true_y.append(aromas_scales[i][aromas_id])
-            
-        final_pred_y = self.sig(torch.cat(final_pred_y))
-        true_y = torch.cat(true_y)
+        # aromas with a non-zero scale, flattened row by row
+        mask = aromas_scales != 0
+        final_pred_y = self.sig(pred_y.gather(1, aromas)[mask])
+        true_y = aromas_scales.gather(1, aromas)[mask]
         
         return final_pred_y, true_y
     
+    def encode(self, types=None, countries=None, aromas=None,
+               aromas_scales=None, tastes=None, tastes_scales=None,
+               grapes=None, grapes_scales=None):
+        x = self.encoder(types=types, countries=countries, 
+                        grapes=grapes, grapes_scales=grapes_scales,
+                        aromas=aromas, aromas_scales=aromas_scales, 
+                        tastes=tastes, tastes_scales=tastes_scales)
+        
+        x, _ = torch.max(x, dim=1)
+        return x
+    
+    def predict_tastes(self, x):
+        """ Taste head on wine embeddings, np.array in and out """
+        with torch.inference_mode():
+            y = self.common_fc(torch.from_numpy(np.asarray(x, dtype=np.float32)))
+            return self.sig(self.taste_regressor(y)).numpy()
+    
     def forward(self,types=None, countries=None, aromas=None,
                      aromas_scales=None, tastes=None, tastes_scales=None,
                      grapes=None,  grapes_scales=None):
@@ -234,83 +340,68 @@ class Trainer(nn.Module):
         return y_country, y_type, y_tastes, grape_pred_y, grape_true_y, aroma_pred_y, aroma_true_y
 
 
-def get_initial_vec(model, df_wine, wine_type, bold, tannic, sweet, acidic):
-    # user wine type
-    wine_type = 0 if wine_type == 'White' else 1
-    
-    # get user taste ['Bold', 'Tannic', 'Sweet', 'Acidic']
-    my_taste = [bold, tannic, sweet, acidic]
-    
-    # get wine taste ['Bold', 'Tannic', 'Sweet', 'Acidic']
-    df_embedding = df_wine[['embeddings']]
-    all_vecs = df_wine[['bold', 'tannic', 'sweet', 'acidic']].fillna(0)
-    
-    # get l2 norm of wine taste with my taste
-    dist = np.sum((all_vecs.values - my_taste)**2, axis=1)**(1/2)
-    df = pd.DataFrame(data=dist, index=all_vecs.index, columns=['dist']).sort_values(by='dist').drop_duplicates()
-    top50 = df.iloc[:50].index
-    
-    # get average representation of 10 random vectors. Iterate over 50 times.
-    random_vecs = []
-    for i in range(50):
-        random_items = random.sample(top50.tolist(), 10)
-        random_vecs.append(np.mean(df_embedding.iloc[random_items].values, axis=0)[0])
-    
-    # make it into torch.float32 from np.float32
-    random_vecs = np.stack(random_vecs)
-    random_vecs = torch.from_numpy(random_vecs)
-    
-    # predict taste
-    y = model.common_fc(random_vecs.float())
-    y_tastes = model.sig(model.taste_regressor(y)).cpu().detach().numpy()
-    
-    # return predicted representation
-    min_index = np.argmin(np.sum((y_tastes - my_taste)**2,axis=1)**(1/2))
-    my_vec = random_vecs[min_index].cpu().detach().numpy()
-    return my_vec
-
-
-def recommend_wine(df_embedding, my_vec):
-    dist = np.sum((df_embedding - my_vec)**2, axis=1)**(1/2)
-    dist = pd.DataFrame(dist, columns=['dist']).sort_values(by='dist')
-    return dist
-
-
-def best_grapes(best_df_dataset, embedding):
-    grapes1 = embedding.grapes_list[best_df_dataset.type1]
-    grapes2 = embedding.grapes_list[best_df_dataset.type2]
-    grapes3 = embedding.grapes_list[best_df_dataset.type3]
-    grapes4 = embedding.grapes_list[best_df_dataset.type4]
-    grapes5 = embedding.grapes_list[best_df_dataset.type5]
-    grapes6 = embedding.grapes_list[best_df_dataset.type6]
-    grapes7 = embedding.grapes_list[best_df_dataset.type7]
-    grapes8 = embedding.grapes_list[best_df_dataset.type8]
-    grapes = np.concatenate([grapes1,grapes2,grapes3,grapes4,grapes5,grapes6,grapes7,grapes8])
-    
-    top_grapes = [i[0] for i in Counter(grapes).most_common()]
-    
-    try:
-        top_grapes.remove('PAD')
-    except:
-        pass
-        
-    return top_grapes
+class Wine_Encoder(nn.Module):
+    """ Serving wrapper of Trainer.encode with positional inputs, so it can be
+    traced to TorchScript or compiled.
+    """
+    def __init__(self, model):
+        super(Wine_Encoder, self).__init__()
+        self.model = model
+        
+    def forward(self, types, countries, aromas, aromas_scales, tastes, tastes_scales, grapes, grapes_scales):
+        return self.model.encode(types=types, countries=countries,
+                                 aromas=aromas, aromas_scales=aromas_scales,
+                                 tastes=tastes, tastes_scales=tastes_scales,
+                                 grapes=grapes, grapes_scales=grapes_scales)
 
 
-def best_countries(best_df_dataset, embedding):
-    countries = best_df_dataset['country']
-    top_countries = [i[0] for i in Counter(countries).most_common()]
-    
-    return top_countries
+WINE_FEATURES = ['types', 'countries', 'aromas', 'aromas_scales', 'tastes', 'tastes_scales', 'grapes', 'grapes_scales']
+
+
+def inference_encoder(model, backend=None, example_features=None):
+    """ Wine encoder for serving: eval mode, no parameter gradients and fused
+    attention. Call it under torch.inference_mode(), as encode_wines does.
 
+    Args:
+        model (Trainer): wine model
+        backend (str, optional): None, 'torchscript' or 'compile'. Defaults to None.
+        example_features (dict, optional): example inputs, required for 'torchscript'.
 
-def best_continent(best_df_dataset, embedding):
-    continents = best_df_dataset['continent']
-    top_continents = [i[0] for i in Counter(continents).most_common()]
+    Returns:
+        nn.Module: encoder taking WINE_FEATURES positionally
+    """
+    encoder = Wine_Encoder(model).eval()
+    encoder.requires_grad_(False)
     
-    return top_continents
+    if backend == 'torchscript':
+        example_inputs = tuple(example_features[k] for k in WINE_FEATURES)
+        with torch.no_grad():
+            encoder = torch.jit.freeze(torch.jit.trace(encoder, example_inputs, check_trace=False))
+    elif backend == 'compile':
+        encoder = torch.compile(encoder, dynamic=True)
+    elif backend is not None:
+        raise ValueError(f"Unknown backend: {backend}")
+    return encoder
+
+
+def encode_wines(encoder, features):
+    """ Encode a batch of wines into (n_wines, 256) embeddings """
+    with torch.inference_mode():
+        return encoder(*[features[k] for k in WINE_FEATURES])
+
 
+def export_taste_head(model, path=TASTE_HEAD_PATH):
+    """ Dump the weights the signup path needs (common_fc, taste_regressor)
+    and the grape vocabulary to a small .npz read by recommend.Taste_Head.
 
-def update_my_vec(my_vec, target_wine_vec, rate):
-    my_vec = (my_vec *(2-rate/5) + target_wine_vec*(rate/5))/2
-    return my_vec
+    Args:
+        model (Trainer): float wine model
+        path (str, optional): output file. Defaults to TASTE_HEAD_PATH.
+    """
+    save_npz(path,
+             common_w=model.common_fc.weight.detach().numpy(),
+             common_b=model.common_fc.bias.detach().numpy(),
+             taste_w=model.taste_regressor.weight.detach().numpy(),
+             taste_b=model.taste_regressor.bias.detach().numpy(),
+             grapes_list=model.encoder.embedding.grapes_list.astype(str),
+             model_digest=np.array(model_digest(MODEL_PATH)))
@@ -1,12 +1,13 @@
 import streamlit as st
 import pandas as pd
 import folium
+from folium.plugins import MarkerCluster
 from streamlit_folium import st_folium, folium_static
 import random
 import math
 import numpy as np
 from db import *
-import toy_markets
+from markets import geocode, haversine_km, load_inventory
 
 
 # toy_market.py 쓰지마세용
@@ -22,8 +23,8 @@ import toy_markets
 #wine_info = pd.read_csv('./.streamlit/vivino_dataset.csv')
 #toy_data_info = pd.read_csv('./.streamlit/Markets.csv')
 
-toy_data_info = toy_markets.toy_df
 #toy_data_info = pd.DataFrame(toy_data_info)
+inventory = load_inventory()
 
 # 10
 max_price_range = [99.5, 99.8, 99.7, 99.6, 99.5, 99.4, 99.3, 99.1, 99]
@@ -31,6 +32,17 @@ min_price_range = [98.9, 98.7, 98.3, 98, 97.8, 96, 95, 94, 90]
 
 select = random.randrange(0, 10)
 
+# GIST, where the map centers without a known user address
+DEFAULT_LOCATION = (35.228956, 126.843181)
+NEAREST_MARKETS = 3
+
+MAP_ZOOM = 16
+# markets sent to the map at most, nearest to the viewport center first
+MAX_MARKERS = 200
+# markets are loaded for the viewport grown by this fraction on every side,
+# so small pans reuse the same map
+VIEWPORT_PADDING = 0.5
+
 #df_wine = select_table('wines')
 #df_wine_csv = 
 
@@ -42,7 +54,7 @@ def main_page():
 
     with col1:
         st.title('Which wine are you looking for?🍷')
-        wine = st.selectbox('', (toy_data_info['name']), label_visibility='collapsed')
+        wine = st.selectbox('', inventory.wine_names(), label_visibility='collapsed')
         #wine_idx = toy_data_info[toy_data_info['name'] == wine].index
 
         if st.button('Search'):
@@ -54,42 +66,86 @@ def main_page():
 
 
     st.title('지도 🎈')
-    m = folium.Map(location=[35.228956, 126.843181], zoom_start=16)
+    address, location = user_location()
+    viewport = map_viewport(address, location)
+    m = market_map(inventory.version, viewport['box'], viewport['center'], viewport['zoom'], address, location)
+    st_data = st_folium(m, key='market_map', width=725)
+    market_details(st_data)
+
+    st.subheader(f"Closest stores to {address or 'GIST'}")
+    nearest = inventory.nearest_markets(*location, k=NEAREST_MARKETS)
+    st.dataframe(nearest.set_index('market_name')[['distance_km']].round(2))
+
+    st.title('와인 매장을 보여드릴게요 🐾')
+
+    market_ids = inventory.markets['market_id'].tolist()
+    market_id = st.selectbox('Store', market_ids, index=market_ids.index(nearest['market_id'].iloc[0]),
+                             format_func=lambda market_id: inventory.markets.at[market_id, 'market_name'])
+    st.button('Show store', on_click=open_market_page, args=(market_id,))
+
+
+def map_viewport(address, location):
+    """ Box of markets to load, center and zoom of the map. The box is the
+    last viewport reported by the map, padded, and is kept while the user pans
+    and zooms inside it, so the map is not rebuilt.
+    """
+    loaded = st.session_state.get('map_viewport')
+    if loaded is not None and loaded['address'] != address:
+        loaded = None
+
+    view = st.session_state.get('market_map') or {}
+    bounds = view.get('bounds') or {}
+    south_west, north_east = bounds.get('_southWest') or {}, bounds.get('_northEast') or {}
+    if south_west.get('lat') is None or north_east.get('lat') is None:
+        if loaded is not None:
+            return loaded
+        # no viewport reported yet, start around the user
+        south, west, north, east = location[0] - 0.01, location[1] - 0.015, location[0] + 0.01, location[1] + 0.015
+        center, zoom = location, MAP_ZOOM
+    else:
+        south, west = south_west['lat'], south_west['lng']
+        north, east = north_east['lat'], north_east['lng']
+        if loaded is not None:
+            box_south, box_west, box_north, box_east = loaded['box']
+            if box_south <= south and box_west <= west and north <= box_north and east <= box_east:
+                return loaded
+        center, zoom = ((south + north) / 2, (west + east) / 2), view.get('zoom') or MAP_ZOOM
+
+    lat_pad, lon_pad = (north - south) * VIEWPORT_PADDING, (east - west) * VIEWPORT_PADDING
+    box = (south - lat_pad, west - lon_pad, north + lat_pad, east + lon_pad)
+    loaded = {'address': address, 'box': tuple(round(bound, 5) for bound in box),
+              'center': tuple(round(coordinate, 5) for coordinate in center), 'zoom': zoom}
+    st.session_state['map_viewport'] = loaded
+    return loaded
+
+
+@st.cache_data(max_entries=64)
+def market_map(inventory_version, box, center, zoom, address, location):
+    """ Clustered folium map of the markets inside `box`, built once per
+    inventory version and viewport. Every caller gets its own copy, as
+    st_folium alters the map it renders. Markers only carry their market's
+    name; the inventory is loaded on click, see market_details.
+    """
+    m = folium.Map(location=center, zoom_start=zoom)
     folium.Marker(
         [35.228956, 126.843181],
         popup='GIST',
         tooltip='Dasan'
     ).add_to(m)
-    
-    inventoryA=''
-    for i in range(18) : # 18개
-        inventoryA = inventoryA + toy_data_info['name'][i] + '\n - '
-
-    markerA = folium.Marker(
-        [35.22115148181801, 126.84508234413954],
-        popup=folium.Popup(inventoryA[:-2], max_width=250),
-        tooltip='MARKET A'
-    ).add_to(m)
-
-    inventoryB=''
-    for i in range(18, 48) : # 12개
-        inventoryB = inventoryB + toy_data_info['name'][i] + '\n - '
-
-    markerB = folium.Marker(
-        [35.22359306367261, 126.85141562924461],
-        popup=folium.Popup(inventoryB[:-2], max_width=250),
-        tooltip='MARKET B'
-    ).add_to(m)
-
-    inventoryC=''
-    for i in range(48, 63) : #30개
-        inventoryC = inventoryC + toy_data_info['name'][i] + '\n - '
-
-    markerC = folium.Marker(
-        [35.221234713907336, 126.8540341090701],
-        popup=folium.Popup(inventoryC[:-2], max_width=300),
-        tooltip='MARKET C'
-    ).add_to(m)
+    if address is not None:
+        folium.Marker(
+            location,
+            icon=folium.Icon(color="green", icon="home"),
+            tooltip=address
+        ).add_to(m)
+
+    markets = inventory.markets_in_box(*box)
+    if len(markets) > MAX_MARKERS:
+        distances = haversine_km(center[0], center[1], markets['lat'].values, markets['lon'].values)
+        markets = markets.iloc[np.argsort(distances, kind='stable')[:MAX_MARKERS]]
+    cluster = MarkerCluster().add_to(m)
+    for market in markets.itertuples():
+        folium.Marker([market.lat, market.lon], tooltip=market.market_name).add_to(cluster)
 
     folium.Marker(
         location=[35.234738, 126.838680],
@@ -97,344 +153,83 @@ def main_page():
         popup=folium.Popup("I'm a red marker", max_width=300),
         tooltip='Red Marker'
     ).add_to(m)
+    return m
 
-    st_data = st_folium(m, width=725)
 
-    st.title('와인 매장을 보여드릴게요 🐾')
+def market_details(st_data):
+    """ Inventory of the market marker clicked last """
+    clicked = (st_data or {}).get('last_object_clicked')
+    if not clicked:
+        return
+    market = inventory.nearest_markets(clicked['lat'], clicked['lng'], k=1)
+    # other markers (GIST, home) are not markets
+    if market.empty or market['distance_km'].iloc[0] > 0.001:
+        return
+    market = market.iloc[0]
+    st.subheader(market['market_name'])
+    listings = inventory.market_inventory(market['market_id'])
+    st.dataframe(listings[listing_columns(listings)])
+
 
-        
-    if st.button('MARKET A'):
-        st.session_state['main_page'] = 'page1'
-        st.dataframe(toy_data_info.loc[:17, ['name', 'cost', 'min_cost', 'max_cost']])
+def listing_columns(listings):
+    """ Listing columns shown in store tables; the online price range is optional """
+    return [column for column in ['wine_name', 'price', 'min_price', 'max_price'] if column in listings]
 
-            
-    if st.button('MARKET B'):
-        st.session_state['main_page'] = 'page2'
-        st.dataframe(toy_data_info.loc[18:47, ['name', 'cost', 'min_cost', 'max_cost']])
 
+def open_market_page(market_id):
+    st.session_state['main_page'] = 'market_page'
+    st.session_state['market_id'] = market_id
 
-        
-    if st.button('MARKET C'):
-        st.session_state['main_page'] = 'page3'
-        st.dataframe(toy_data_info.loc[48:63, ['name', 'cost', 'min_cost', 'max_cost']])
 
+def user_location():
+    """ Address and coordinates of the logged-in user, GIST when unknown """
+    profile = st.session_state.get('profile')
+    address = profile['address'][0] if profile is not None else None
+    location = geocode(address)
+    if location is None:
+        return None, DEFAULT_LOCATION
+    return address, location
 
 
 mins = 90.0
 maxs = 101.2
 def search_page(code):
-
-    # 와인 재고 toy data
-    inventoryA = toy_data_info.loc[:17, ['name', 'cost', ]]
-    inventoryB = toy_data_info.loc[18:38, ['name', 'cost']]
-    inventoryC = toy_data_info.loc[38:63, ['name', 'cost']]
-    
-    if code in str(inventoryA.values):
-        st.write("**<span style='background-color: #A9D0F5;'>MAERKET A </span>** 에 찾는 와인이 있어용 ~", unsafe_allow_html=True)
-        result = inventoryA[inventoryA['name'].str.contains(code)]
-        if not result.empty:
-            st.write(f"**NAME**: {result.iloc[0]['name']}")
-
-            cost = result.iloc[0]['cost']
-            min_cost = float(cost) * mins/100
-            min_cost = math.trunc(min_cost)
-            min_cost = '{:,}'.format(min_cost)
-
-            max_cost = float(cost) * maxs/100
-            max_cost = math.trunc(max_cost)
-            max_cost = '{:,}'.format(max_cost)
-
-            cost = '{:,}'.format(cost)
-            st.write('**✨BEST PRICE✨ : ₩**', cost)
-            st.write('**Online Price Min/Max : ₩**', min_cost, '|', max_cost)
-
-            st.write('---------------------')
-        else:
-            st.write(f"**No results found for \"{code}\"**")
-
-    if code in str(inventoryB.values):
-        st.write("**<span style='background-color: #81BEF7;'>MAERKET B </span>** 에 찾는 와인이 있어용 ~", unsafe_allow_html=True)
-        result = inventoryB[inventoryB['name'].str.contains(code)]
-        if not result.empty:
-            st.write(f"**NAME**: {result.iloc[0]['name']}")
-            cost = result.iloc[0]['cost']
-            min_cost = float(cost) * mins/100
-            min_cost = math.trunc(min_cost)
-            min_cost = '{:,}'.format(min_cost)
-
-            max_cost = float(cost) * maxs/100
-            max_cost = math.trunc(max_cost)
-            max_cost = '{:,}'.format(max_cost)
-
-            cost = '{:,}'.format(cost)
-            st.write('**✨BEST PRICE✨ : ₩**', cost)
-            st.write('**Online Price Min/Max : ₩**', min_cost, '|', max_cost)
-            st.write('---------------------')
-        else:
-            st.write(f"**No results found for \"{code}\"**")
-
-    if code in str(inventoryC.values):
-        st.write("**<span style='background-color: #E3CEF6;'>MAERKET C </span>** 에 찾는 와인이 있어용 ~", unsafe_allow_html=True)
-        result = inventoryC[inventoryC['name'].str.contains(code)]
-        if not result.empty:
-            st.write(f"**NAME**: {result.iloc[0]['name']}")
-            cost = result.iloc[0]['cost']
-            min_cost = float(cost) * mins/100
-            min_cost = math.trunc(min_cost)
-            min_cost = '{:,}'.format(min_cost)
-
-            max_cost = float(cost) * maxs/100
-            max_cost = math.trunc(max_cost)
-            max_cost = '{:,}'.format(max_cost)
-
-            cost = '{:,}'.format(cost)
-            st.write('**✨BEST PRICE✨ : ₩**', cost)
-            st.write('**Online Price Min/Max : ₩**', min_cost, '|', max_cost)
-        else:
-            st.write(f"**No results found for \"{code}\"**")
-
-
-    elif code not in str(inventoryA.values) and code not in str(inventoryB.values) and code not in str(inventoryC.values):
+    listings = inventory.find(code)
+    if listings.empty:
         st.write(f"**No results found for \"{code}\"**")
+        return
+
+    # cheapest market first
+    for listing in listings.itertuples():
+        st.write(f"**<span style='background-color: {listing.color};'>{listing.market_name} </span>** 에 찾는 와인이 있어용 ~", unsafe_allow_html=True)
+        st.write(f"**NAME**: {listing.wine_name}")
+
+        min_cost = math.trunc(float(listing.price) * mins/100)
+        max_cost = math.trunc(float(listing.price) * maxs/100)
+        st.write('**✨BEST PRICE✨ : ₩**', '{:,}'.format(listing.price))
+        st.write('**Online Price Min/Max : ₩**', '{:,}'.format(min_cost), '|', '{:,}'.format(max_cost))
+        st.write('---------------------')
+
+
+def market_page():
+    market_id = st.session_state['market_id']
+    st.title(inventory.markets.at[market_id, 'market_name'])
+    listings = inventory.market_inventory(market_id)
+
+    # wines fill the columns left to right
+    for column, (_, listing) in zip(st.columns(3) * len(listings), listings.iterrows()):
+        with column:
+            if 'imgurl' in listing:
+                st.image(listing['imgurl'], caption=listing['wine_name'], width = 100)
+            else:
+                st.write(f"**{listing['wine_name']}**")
+            for detail in ['type', 'city', 'date']:
+                if detail in listing:
+                    st.write(f'**{detail}** : ', listing[detail])
 
-
-def page1():
-
-    col1, col2, col3 = st.columns(3)
-
-    n=6
-
-    with col1:
-
-        for i in range(n):
-            
-            st.write(st.session_state.get('message', ''))
-
-            st.image(toy_data_info['imgurl'][i], caption=toy_data_info['name'][i], width = 100)
-            st.write('**type** : ', toy_data_info['type'][i])
-            st.write('**city** : ', toy_data_info['city'][i])
-            date = toy_data_info['date'][i]
-            st.write('**date** :', date)
-            
-            cost = toy_data_info['cost'][i]
-            min_cost = toy_data_info['min_cost'][i]
-            max_cost = toy_data_info['max_cost'][i]
-
-            cost = '{:,}'.format(toy_data_info['cost'][i])
-            min_cost = '{:,}'.format(toy_data_info['min_cost'][i])
-            max_cost = '{:,}'.format(toy_data_info['max_cost'][i])
-
-            st.write('**cost : ₩**', cost)
-            st.write('**min/max : ₩**', min_cost, '|', max_cost)
-
-        
-    with col2:
-
-        for i in range(n, 2*n):
-            st.write(st.session_state.get('message', ''))
-
-            st.image(toy_data_info['imgurl'][i], caption=toy_data_info['name'][i], width = 100)
-            st.write('**type** : ', toy_data_info['type'][i])
-            st.write('**city** : ', toy_data_info['city'][i])
-            date = toy_data_info['date'][i]
-            st.write('**date** :', date)
-            
-            cost = toy_data_info['cost'][i]
-            min_cost = toy_data_info['min_cost'][i]
-            max_cost = toy_data_info['max_cost'][i]
-
-            cost = '{:,}'.format(toy_data_info['cost'][i])
-            min_cost = '{:,}'.format(toy_data_info['min_cost'][i])
-            max_cost = '{:,}'.format(toy_data_info['max_cost'][i])
-
-            st.write('**cost : ₩**', cost)
-            st.write('**min/max : ₩**', min_cost, '|', max_cost)
-
-
-
-    with col3:
-
-        for i in range(2*n, 3*n):
-            st.write(st.session_state.get('message', ''))
-
-            st.image(toy_data_info['imgurl'][i], caption=toy_data_info['name'][i], width = 100)
-            st.write('**type** : ', toy_data_info['type'][i])
-            st.write('**city** : ', toy_data_info['city'][i])
-            date = toy_data_info['date'][i]
-            st.write('**date** :', date)
-            
-            cost = toy_data_info['cost'][i]
-            min_cost = toy_data_info['min_cost'][i]
-            max_cost = toy_data_info['max_cost'][i]
-
-            cost = '{:,}'.format(toy_data_info['cost'][i])
-            min_cost = '{:,}'.format(toy_data_info['min_cost'][i])
-            max_cost = '{:,}'.format(toy_data_info['max_cost'][i])
-
-            st.write('**cost : ₩**', cost)
-            st.write('**min/max : ₩**', min_cost, '|', max_cost)
-
-    if st.button('뒤로가기'):
-        st.session_state['main_page'] = 'main_page'
-
-
-def page2():
-    
-    col1, col2, col3 = st.columns(3)
-
-    n=10
-
-    with col1:
-
-        for i in range(18 , 18 + 1*n):
-            
-            st.write(st.session_state.get('message', ''))
-
-            st.image(toy_data_info['imgurl'][i], caption=toy_data_info['name'][i], width = 100)
-            st.write('**type** : ', toy_data_info['type'][i])
-            st.write('**city** : ', toy_data_info['city'][i])
-            date = toy_data_info['date'][i]
-            st.write('**date** :', date)
-            
-            cost = toy_data_info['cost'][i]
-            min_cost = toy_data_info['min_cost'][i]
-            max_cost = toy_data_info['max_cost'][i]
-
-            cost = '{:,}'.format(toy_data_info['cost'][i])
-            min_cost = '{:,}'.format(toy_data_info['min_cost'][i])
-            max_cost = '{:,}'.format(toy_data_info['max_cost'][i])
-
-            st.write('**cost : ₩**', cost)
-            st.write('**min/max : ₩**', min_cost, '|', max_cost)
-
-        
-    with col2:
-
-        for i in range(18 + 1*n, 18 + 2*n):
-            st.write(st.session_state.get('message', ''))
-
-            st.image(toy_data_info['imgurl'][i], caption=toy_data_info['name'][i], width = 100)
-            st.write('**type** : ', toy_data_info['type'][i])
-            st.write('**city** : ', toy_data_info['city'][i])
-            date = toy_data_info['date'][i]
-            st.write('**date** :', date)
-            
-            cost = toy_data_info['cost'][i]
-            min_cost = toy_data_info['min_cost'][i]
-            max_cost = toy_data_info['max_cost'][i]
-
-            cost = '{:,}'.format(toy_data_info['cost'][i])
-            min_cost = '{:,}'.format(toy_data_info['min_cost'][i])
-            max_cost = '{:,}'.format(toy_data_info['max_cost'][i])
-
-            st.write('**cost : ₩**', cost)
-            st.write('**min/max : ₩**', min_cost, '|', max_cost)
-
-
-
-    with col3:
-
-        for i in range(18 + 2*n, 18 + 3*n):
-            st.write(st.session_state.get('message', ''))
-
-            st.image(toy_data_info['imgurl'][i], caption=toy_data_info['name'][i], width = 100)
-            st.write('**type** : ', toy_data_info['type'][i])
-            st.write('**city** : ', toy_data_info['city'][i])
-            date = toy_data_info['date'][i]
-            st.write('**date** :', date)
-            
-            cost = toy_data_info['cost'][i]
-            min_cost = toy_data_info['min_cost'][i]
-            max_cost = toy_data_info['max_cost'][i]
-
-            cost = '{:,}'.format(toy_data_info['cost'][i])
-            min_cost = '{:,}'.format(toy_data_info['min_cost'][i])
-            max_cost = '{:,}'.format(toy_data_info['max_cost'][i])
-
-            st.write('**cost : ₩**', cost)
-            st.write('**min/max : ₩**', min_cost, '|', max_cost)
-
-
-    if st.button('뒤로가기'):
-        st.session_state['main_page'] = 'main_page'
-
-
-def page3():
-    col1, col2, col3 = st.columns(3)
-
-    n=4
-
-    with col1:
-
-        for i in range(48 , 48 + 1*n):
-            
-            st.write(st.session_state.get('message', ''))
-
-            st.image(toy_data_info['imgurl'][i], caption=toy_data_info['name'][i], width = 100)
-            st.write('**type** : ', toy_data_info['type'][i])
-            st.write('**city** : ', toy_data_info['city'][i])
-            date = toy_data_info['date'][i]
-            st.write('**date** :', date)
-            
-            cost = toy_data_info['cost'][i]
-            min_cost = toy_data_info['min_cost'][i]
-            max_cost = toy_data_info['max_cost'][i]
-
-            cost = '{:,}'.format(toy_data_info['cost'][i])
-            min_cost = '{:,}'.format(toy_data_info['min_cost'][i])
-            max_cost = '{:,}'.format(toy_data_info['max_cost'][i])
-
-            st.write('**cost : ₩**', cost)
-            st.write('**min/max : ₩**', min_cost, '|', max_cost)
-
-
-        
-    with col2:
-
-        for i in range(48 + 1*n, 48 + 2*n):
-            st.write(st.session_state.get('message', ''))
-
-            st.image(toy_data_info['imgurl'][i], caption=toy_data_info['name'][i], width = 100)
-            st.write('**type** : ', toy_data_info['type'][i])
-            st.write('**city** : ', toy_data_info['city'][i])
-            date = toy_data_info['date'][i]
-            st.write('**date** :', date)
-            
-            cost = toy_data_info['cost'][i]
-            min_cost = toy_data_info['min_cost'][i]
-            max_cost = toy_data_info['max_cost'][i]
-
-            cost = '{:,}'.format(toy_data_info['cost'][i])
-            min_cost = '{:,}'.format(toy_data_info['min_cost'][i])
-            max_cost = '{:,}'.format(toy_data_info['max_cost'][i])
-
-            st.write('**cost : ₩**', cost)
-            st.write('**min/max : ₩**', min_cost, '|', max_cost)
-
-
-
-    with col3:
-
-        for i in range(48 + 2*n, 48 + 3*n):
-            st.write(st.session_state.get('message', ''))
-
-            st.image(toy_data_info['imgurl'][i], caption=toy_data_info['name'][i], width = 100)
-            st.write('**type** : ', toy_data_info['type'][i])
-            st.write('**city** : ', toy_data_info['city'][i])
-            date = toy_data_info['date'][i]
-            st.write('**date** :', date)
-            
-            cost = toy_data_info['cost'][i]
-            min_cost = toy_data_info['min_cost'][i]
-            max_cost = toy_data_info['max_cost'][i]
-
-            cost = '{:,}'.format(toy_data_info['cost'][i])
-            min_cost = '{:,}'.format(toy_data_info['min_cost'][i])
-            max_cost = '{:,}'.format(toy_data_info['max_cost'][i])
-
-            st.write('**cost : ₩**', cost)
-            st.write('**min/max : ₩**', min_cost, '|', max_cost)
-
+            st.write('**cost : ₩**', '{:,}'.format(listing['price']))
+            if 'min_price' in listing and 'max_price' in listing:
+                st.write('**min/max : ₩**', '{:,}'.format(listing['min_price']), '|', '{:,}'.format(listing['max_price']))
 
     if st.button('뒤로가기'):
         st.session_state['main_page'] = 'main_page'
@@ -444,10 +239,6 @@ st.session_state.setdefault('main_page', 'main_page')
 
 if st.session_state['main_page'] == 'main_page':
     main_page()
-elif st.session_state['main_page'] == 'page1':
-    page1()
-elif st.session_state['main_page'] == 'page2':
-    page2()
-elif st.session_state['main_page'] == 'page3':
-    page3()
+elif st.session_state['main_page'] == 'market_page':
+    market_page()
 
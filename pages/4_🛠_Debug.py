@@ -0,0 +1,64 @@
+import sys
+import pandas as pd
+import streamlit as st
+from db import *
+
+
+st.title("Debug")
+
+query_log = init_query_log()
+report = query_log.report()
+
+# Queries
+st.subheader("Queries")
+col1, col2, col3, col4 = st.columns(4)
+col1.metric("Templates", len(report))
+col2.metric("Calls", int(report['calls'].sum()))
+col3.metric("Slow calls", int(report['slow_calls'].sum()))
+col4.metric("Errors", int(report['errors'].sum()))
+
+st.dataframe(report.drop(columns=['histogram', 'plan']), use_container_width=True)
+
+if len(report):
+    template = st.selectbox("Latency histogram", report['template'])
+    row = report[report['template'] == template].iloc[0]
+    histogram = pd.DataFrame({'calls': row['histogram']}, index=[f"≤ {bound}s" for bound in LATENCY_BUCKETS])
+    st.bar_chart(histogram)
+    if row['plan']:
+        st.code(row['plan'])
+
+st.subheader(f"Slow queries (≥ {query_log.slow_threshold}s)")
+slow_queries = query_log.slow_queries()
+if slow_queries:
+    slow_df = pd.DataFrame(slow_queries)
+    slow_df['time'] = pd.to_datetime(slow_df['time'], unit='s')
+    st.dataframe(slow_df, use_container_width=True)
+else:
+    st.write("No slow queries yet.")
+
+# Caches and pools
+backend_stats = get_backend().stats()
+query_cache_stats = init_query_cache().stats()
+user_writer_stats = init_user_writer().stats()
+# models imports torch, only report load times when a page already loaded it
+models = sys.modules.get('models')
+load_stats = dict(models.load_stats) if models is not None else {}
+
+st.subheader("Connection pool")
+st.json(backend_stats)
+st.subheader("Query cache")
+st.json(query_cache_stats)
+st.subheader("User write-behind")
+st.json(user_writer_stats)
+st.subheader("Model load times (s)")
+st.json(load_stats)
+
+# Report
+col1, col2 = st.columns([3, 1])
+with col1:
+    st.download_button("Download report", query_log.dump(pool=backend_stats, query_cache=query_cache_stats,
+                                                         user_writer=user_writer_stats, model_load=load_stats),
+                       file_name='query_report.json', mime='application/json')
+with col2:
+    if st.button("Reset"):
+        query_log.reset()
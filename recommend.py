@@ -0,0 +1,538 @@
+import hashlib
+import os
+from collections import Counter
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+
+MODEL_PATH = 'wine_model.pt'
+INDEX_PATH = 'wine_index.npz'
+INITIAL_VEC_PATH = 'wine_initial_vecs.npz'
+TASTE_HEAD_PATH = 'wine_taste_head.npz'
+
+# signup sliders offer 0.0, 0.1, ..., 1.0 for each taste
+TASTE_LEVELS = 11
+
+# number of catalog rows below which an exact scan is cheaper than the index
+MIN_INDEX_ROWS = 20000
+# default buckets scanned per query: N_PROBE_FRACTION of them, at least N_PROBE,
+# and enough for about N_PROBE_CANDIDATES * k candidates. On 50k model-encoded
+# wines (sqrt(n) buckets) this keeps both recall@10 and recall@200 around 0.97,
+# see `python benchmark.py recommend`
+N_PROBE = 8
+N_PROBE_FRACTION = 0.1
+N_PROBE_CANDIDATES = 50
+
+
+def catalog_fingerprint(matrix):
+    """ Fingerprint of a catalog matrix, e.g. its embeddings. Hashes its shape
+    and every row, so artifacts built from the catalog detect any change to it.
+    Hashing a large catalog takes a while, so callers compute it once per
+    catalog version.
+
+    Args:
+        matrix (np.array): (n_wines, dim) catalog matrix
+
+    Returns:
+        str: hex digest
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    digest = hashlib.sha1(str(matrix.shape).encode())
+    digest.update(matrix)
+    return digest.hexdigest()
+
+
+def save_npz(path, **arrays):
+    """ np.savez to a temporary file then renamed over `path`, so processes
+    loading the artifact never read a half-written file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def model_digest(path=MODEL_PATH):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class Taste_Head:
+    """ NumPy forward of Trainer.common_fc -> taste_regressor -> sigmoid, the
+    only part of the model signup needs. Weights come from
+    models.export_taste_head, so serving it does not import torch.
+    """
+    def __init__(self, common_w, common_b, taste_w, taste_b, grapes_list):
+        self.common_w = common_w
+        self.common_b = common_b
+        self.taste_w = taste_w
+        self.taste_b = taste_b
+        self.grapes_list = grapes_list
+
+    @classmethod
+    def load(cls, path=TASTE_HEAD_PATH, model_path=MODEL_PATH):
+        """ Load an exported taste head.
+
+        Returns:
+            Taste_Head: loaded head, or None if the file is missing or was
+            exported from a different wine_model.pt.
+        """
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as saved:
+            if str(saved['model_digest']) != model_digest(model_path):
+                return None
+            return cls(saved['common_w'], saved['common_b'], saved['taste_w'], saved['taste_b'],
+                       saved['grapes_list'].astype(object))
+
+    def predict_tastes(self, x):
+        y = np.asarray(x, dtype=np.float32) @ self.common_w.T + self.common_b
+        y = y @ self.taste_w.T + self.taste_b
+        return 1 / (1 + np.exp(-y))
+
+
+def load_taste_head(path=TASTE_HEAD_PATH):
+    """ Shared exported taste head, or None until build_artifacts.py exported
+    one. A miss is not cached, so a head exported while the app runs is
+    picked up by the next call.
+    """
+    taste_head = _load_taste_head(path)
+    if taste_head is None:
+        _load_taste_head.clear()
+    return taste_head
+
+
+@st.cache_resource
+def _load_taste_head(path):
+    return Taste_Head.load(path)
+
+
+class IVF_Index:
+    """ Inverted file index over the catalog embedding matrix.
+
+    Rows are bucketed by their nearest k-means centroid. A query scans only the
+    `n_probe` buckets whose centroids are closest to it and ranks those
+    candidates exactly, so `n_probe` is the recall/latency knob.
+    Probing a quarter of the buckets or more is an exact scan.
+    """
+    def __init__(self, matrix, centroids, offsets, order, fingerprint, n_probe=None):
+        self.matrix = matrix
+        self.centroids = centroids
+        self.offsets = offsets
+        self.order = order
+        self.fingerprint = fingerprint
+        self.n_list = len(centroids)
+        self.n_probe = n_probe or max(N_PROBE, int(np.ceil(N_PROBE_FRACTION * self.n_list)))
+        self.norms = squared_norms(matrix)
+
+    @classmethod
+    def build(cls, matrix, n_list=None, n_iter=10, sample_size=100000, seed=0, n_probe=None):
+        """ Train coarse centroids with k-means and bucket every row.
+
+        Args:
+            matrix (np.array): (n_wines, dim) catalog embedding matrix
+            n_list (int, optional): number of buckets. Defaults to sqrt(n_wines),
+                or a single bucket for catalogs smaller than MIN_INDEX_ROWS.
+            n_iter (int, optional): k-means iterations. Defaults to 10.
+            sample_size (int, optional): rows used to train centroids. Defaults to 100000.
+            seed (int, optional): random seed. Defaults to 0.
+            n_probe (int, optional): default buckets scanned per query. Defaults to
+                N_PROBE_FRACTION of the buckets, at least N_PROBE.
+
+        Returns:
+            IVF_Index: index bound to `matrix`
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        n = len(matrix)
+        if n_list is None:
+            n_list = 1 if n < MIN_INDEX_ROWS else int(np.sqrt(n))
+        n_list = max(1, min(n_list, n))
+
+        rng = np.random.default_rng(seed)
+        if n_list == 1:
+            centroids = matrix.mean(axis=0, keepdims=True)
+        else:
+            sample = matrix[rng.choice(n, min(n, sample_size), replace=False)]
+            centroids = _kmeans(sample, n_list, n_iter, rng)
+
+        assign = _nearest_centroid(matrix, centroids)
+        order = np.argsort(assign, kind='stable').astype(np.int64)
+        offsets = np.searchsorted(assign[order], np.arange(n_list + 1))
+
+        return cls(matrix, centroids, offsets, order, catalog_fingerprint(matrix), n_probe)
+
+    def save(self, path=INDEX_PATH):
+        save_npz(path, centroids=self.centroids, offsets=self.offsets,
+                 order=self.order, fingerprint=np.array(self.fingerprint))
+
+    @classmethod
+    def load(cls, matrix, path=INDEX_PATH, n_probe=None):
+        """ Load a persisted index for `matrix`.
+
+        Returns:
+            IVF_Index: loaded index, or None if the file is missing or was built
+            from a different catalog.
+        """
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as saved:
+            fingerprint = str(saved['fingerprint'])
+            if fingerprint != catalog_fingerprint(matrix):
+                return None
+            return cls(matrix, saved['centroids'], saved['offsets'], saved['order'], fingerprint, n_probe)
+
+    def search(self, vec, k=200, n_probe=None):
+        """ Approximate top-k nearest wines by L2 distance.
+
+        Args:
+            vec (np.array): query embedding
+            k (int, optional): number of wines. Defaults to 200.
+            n_probe (int, optional): buckets to scan. Defaults to the index's
+                n_probe, grown to hold about N_PROBE_CANDIDATES * k rows.
+
+        Returns:
+            (np.array, np.array): catalog row indices and distances, nearest first.
+        """
+        vec = np.asarray(vec, dtype=np.float32).ravel()
+        if n_probe is None:
+            # large k need more buckets for the same recall
+            rows_per_list = max(1, len(self.order) / self.n_list)
+            n_probe = max(self.n_probe, int(np.ceil(N_PROBE_CANDIDATES * k / rows_per_list)))
+        n_probe = min(n_probe, self.n_list)
+
+        candidates = None
+        # gathering scattered rows costs a few times the exact scan per row,
+        # so past a quarter of the buckets the exact scan is faster
+        if n_probe * 4 < self.n_list:
+            centroid_dist = np.sum((self.centroids - vec)**2, axis=1)
+            probe = np.argpartition(centroid_dist, n_probe - 1)[:n_probe]
+            candidates = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in probe])
+            # not enough candidates in the probed buckets, fall back to the exact scan
+            if len(candidates) < k:
+                candidates = None
+
+        if candidates is None:
+            return recommend_top_k(self.matrix, vec, k, self.norms)
+
+        top, dist = recommend_top_k(self.matrix[candidates], vec, k, self.norms[candidates])
+        return candidates[top], dist
+
+
+def recommend_top_k(matrix, vec, k=200, norms=None):
+    """ Exact top-k nearest wines by L2 distance. Distances come from
+    ||x||^2 - 2 x.q + ||q||^2, so the only allocation per catalog row is its
+    distance, then the k winners are selected with a partial sort and only
+    those are sorted.
+
+    Args:
+        matrix (np.array): (n_wines, dim) catalog embedding matrix
+        vec (np.array): query embedding
+        k (int, optional): number of wines. Defaults to 200.
+        norms (np.array, optional): `squared_norms(matrix)`. Defaults to None.
+
+    Returns:
+        (np.array, np.array): row indices and distances, nearest first.
+    """
+    vec = np.asarray(vec, dtype=np.float32).ravel()
+    if norms is None:
+        norms = squared_norms(matrix)
+    dist = matrix @ vec
+    dist *= -2
+    dist += norms
+    dist += vec @ vec
+    top = _top_k(dist, k)
+    # rounding can leave tiny negative squared distances
+    return top, np.maximum(dist[top], 0)**(1/2)
+
+
+def squared_norms(matrix):
+    """ Squared L2 norm of every catalog row. Compute once per catalog and pass
+    to `recommend_batch`.
+
+    Args:
+        matrix (np.array): (n_wines, dim) catalog embedding matrix
+
+    Returns:
+        np.array: (n_wines,) float32 squared norms
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return np.einsum('ij,ij->i', matrix, matrix)
+
+
+def recommend_batch(matrix, vecs, k=200, norms=None, max_bytes=256 * 2**20):
+    """ Exact top-k nearest wines for many users at once, the same as
+    `recommend_top_k` per user.
+
+    Distances come from ||x||^2 - 2 x.q + ||q||^2 with one matrix multiply per
+    block of users; blocks are sized so the (users x n_wines) float32 distances
+    and the int64 indices argpartition returns for them stay under `max_bytes`.
+
+    Args:
+        matrix (np.array): (n_wines, dim) catalog embedding matrix
+        vecs (np.array): (n_users, dim) user embeddings
+        k (int, optional): number of wines per user. Defaults to 200.
+        norms (np.array, optional): `squared_norms(matrix)`. Defaults to None.
+        max_bytes (int, optional): memory bound of a block. Defaults to 256MB.
+
+    Returns:
+        (np.array, np.array): (n_users, min(k, n_wines)) row indices and distances, nearest first.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    vecs = np.atleast_2d(np.asarray(vecs, dtype=np.float32))
+    n_users, n_wines = len(vecs), len(matrix)
+    k = min(k, n_wines)
+
+    indices = np.empty((n_users, k), dtype=np.int64)
+    distances = np.empty((n_users, k), dtype=np.float32)
+    if k == 0:
+        return indices, distances
+    if norms is None:
+        norms = squared_norms(matrix)
+
+    # 4 bytes of distance and 8 of argpartition index per (user, wine)
+    block_size = max(1, max_bytes // (12 * n_wines))
+    for start in range(0, n_users, block_size):
+        block = vecs[start:start + block_size]
+        dist = block @ matrix.T
+        dist *= -2
+        dist += norms
+        dist += np.einsum('ij,ij->i', block, block)[:, None]
+
+        top = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        top_dist = np.take_along_axis(dist, top, axis=1)
+        order = np.argsort(top_dist, axis=1, kind='stable')
+
+        indices[start:start + block_size] = np.take_along_axis(top, order, axis=1)
+        # rounding can leave tiny negative squared distances
+        distances[start:start + block_size] = np.maximum(np.take_along_axis(top_dist, order, axis=1), 0)**(1/2)
+    return indices, distances
+
+
+def closest_unique(dist, n):
+    """ Positions of the `n` smallest distinct values of `dist`, nearest first,
+    found with a partial sort over a window that grows only when ties
+    leave fewer than `n` distinct values in it.
+    """
+    window = min(len(dist), 2 * n)
+    while True:
+        if window < len(dist):
+            candidates = np.argpartition(dist, window - 1)[:window]
+        else:
+            candidates = np.arange(len(dist))
+        candidates = candidates[np.argsort(dist[candidates], kind='stable')]
+        _, first = np.unique(dist[candidates], return_index=True)
+        if len(first) >= n or window == len(dist):
+            return candidates[first[:n]]
+        window = min(len(dist), 2 * window)
+
+
+def get_initial_vec(model, df_wine, wine_type, bold, tannic, sweet, acidic, seed=None, n_draws=50, n_samples=10,
+                    df_embedding=None):
+    # user wine type
+    wine_type = 0 if wine_type == 'White' else 1
+    
+    # get user taste ['Bold', 'Tannic', 'Sweet', 'Acidic']
+    my_taste = np.array([bold, tannic, sweet, acidic])
+    
+    # get wine taste ['Bold', 'Tannic', 'Sweet', 'Acidic']
+    all_vecs = df_wine[['bold', 'tannic', 'sweet', 'acidic']].fillna(0).values
+    
+    # get l2 norm of wine taste with my taste, keep the 50 closest distinct distances
+    dist = np.sum((all_vecs - my_taste)**2, axis=1)**(1/2)
+    top50 = closest_unique(dist, 50)
+    
+    # get average representation of 10 random vectors, 50 draws at once
+    rng = np.random.default_rng(seed)
+    n_samples = min(n_samples, len(top50))
+    samples = np.argsort(rng.random((n_draws, len(top50))), axis=1)[:, :n_samples]
+    if df_embedding is None:
+        top_vecs = np.stack(df_wine['embeddings'].values[top50]).astype(np.float32)
+    else:
+        top_vecs = np.asarray(df_embedding[top50], dtype=np.float32)
+    random_vecs = top_vecs[samples].mean(axis=1)
+    
+    # predict taste
+    y_tastes = model.predict_tastes(random_vecs)
+    
+    # return predicted representation
+    min_index = np.argmin(np.sum((y_tastes - my_taste)**2, axis=1))
+    return random_vecs[min_index]
+
+
+def initial_vec_fingerprint(df_wine, df_embedding, model_path=MODEL_PATH):
+    """ Fingerprint of everything the initial vectors depend on: catalog
+    embeddings, catalog tastes and the model weights. Every catalog row is
+    hashed, so any catalog edit invalidates the table; see
+    catalog_initial_vec_fingerprint to hash a catalog version only once.
+    """
+    tastes = df_wine[['bold', 'tannic', 'sweet', 'acidic']].fillna(0).values
+    return ':'.join([catalog_fingerprint(df_embedding), catalog_fingerprint(tastes), model_digest(model_path)])
+
+
+@st.cache_data(max_entries=1)
+def catalog_initial_vec_fingerprint(version, _df_wine, _df_embedding):
+    """ initial_vec_fingerprint of the catalog `version`, see catalog.catalog_version """
+    return initial_vec_fingerprint(_df_wine, _df_embedding)
+
+
+def build_initial_vec_table(model, df_wine, fingerprint, path=INITIAL_VEC_PATH, dtype=np.float16, seed=0,
+                            df_embedding=None):
+    """ Compute the initial user vector of every signup slider combination.
+    get_initial_vec ignores the wine type, so the table is indexed by the four
+    tastes only.
+
+    Args:
+        model (Trainer or Taste_Head): taste predictor
+        df_wine (pd.DataFrame): wine catalog
+        fingerprint (str): initial_vec_fingerprint of the catalog and model
+        path (str, optional): output file. Defaults to INITIAL_VEC_PATH.
+        dtype (np.dtype, optional): stored dtype. Defaults to np.float16.
+        seed (int, optional): base random seed. Defaults to 0.
+        df_embedding (np.array, optional): catalog embedding matrix aligned with df_wine.
+
+    Returns:
+        np.array: (11, 11, 11, 11, dim) table
+    """
+    levels = np.arange(TASTE_LEVELS) / (TASTE_LEVELS - 1)
+    table = None
+    for i, tastes in enumerate(np.ndindex(*[TASTE_LEVELS] * 4)):
+        vec = get_initial_vec(model, df_wine, None, *levels[list(tastes)], seed=seed + i, df_embedding=df_embedding)
+        if table is None:
+            table = np.empty([TASTE_LEVELS] * 4 + [len(vec)], dtype=dtype)
+        table[tastes] = vec
+    save_npz(path, table=table, fingerprint=np.array(fingerprint))
+    return table
+
+
+def load_initial_vec_table(fingerprint, path=INITIAL_VEC_PATH):
+    """ Load the precomputed initial vectors. A miss is not cached, so a table
+    built while the app runs is picked up by the next call.
+
+    Returns:
+        np.array: table, or None if it is missing or stale.
+    """
+    table = _load_initial_vec_table(fingerprint, path)
+    if table is None:
+        _load_initial_vec_table.clear()
+    return table
+
+
+@st.cache_resource(max_entries=1)
+def _load_initial_vec_table(fingerprint, path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        if str(saved['fingerprint']) != fingerprint:
+            return None
+        return saved['table']
+
+
+def lookup_initial_vec(table, bold, tannic, sweet, acidic):
+    tastes = tuple(int(round(t * (TASTE_LEVELS - 1))) for t in (bold, tannic, sweet, acidic))
+    return table[tastes].astype(np.float32)
+
+
+def recommend_wine(df_embedding, my_vec):
+    dist = np.sum((df_embedding - my_vec)**2, axis=1)**(1/2)
+    dist = pd.DataFrame(dist, columns=['dist']).sort_values(by='dist')
+    return dist
+
+
+def best_grapes(best_df_dataset, embedding):
+    grapes1 = embedding.grapes_list[best_df_dataset.type1]
+    grapes2 = embedding.grapes_list[best_df_dataset.type2]
+    grapes3 = embedding.grapes_list[best_df_dataset.type3]
+    grapes4 = embedding.grapes_list[best_df_dataset.type4]
+    grapes5 = embedding.grapes_list[best_df_dataset.type5]
+    grapes6 = embedding.grapes_list[best_df_dataset.type6]
+    grapes7 = embedding.grapes_list[best_df_dataset.type7]
+    grapes8 = embedding.grapes_list[best_df_dataset.type8]
+    grapes = np.concatenate([grapes1,grapes2,grapes3,grapes4,grapes5,grapes6,grapes7,grapes8])
+    
+    top_grapes = [i[0] for i in Counter(grapes).most_common()]
+    
+    try:
+        top_grapes.remove('PAD')
+    except:
+        pass
+        
+    return top_grapes
+
+
+def best_countries(best_df_dataset, embedding):
+    countries = best_df_dataset['country']
+    top_countries = [i[0] for i in Counter(countries).most_common()]
+    
+    return top_countries
+
+
+def best_continent(best_df_dataset, embedding):
+    continents = best_df_dataset['continent']
+    top_continents = [i[0] for i in Counter(continents).most_common()]
+    
+    return top_continents
+
+
+def update_my_vec(my_vec, target_wine_vec, rate):
+    my_vec = (my_vec *(2-rate/5) + target_wine_vec*(rate/5))/2
+    return my_vec
+
+
+def load_index(matrix, version, path=INDEX_PATH, n_probe=None):
+    """ Load the persisted index for the catalog, building and saving it first
+    if it is missing or stale. Shared across sessions; only the index of the
+    current catalog version is kept, and its fingerprint is checked once.
+
+    Args:
+        matrix (np.array): (n_wines, dim) catalog embedding matrix
+        version (str): catalog version of `matrix`, see catalog.catalog_version
+        path (str, optional): index file. Defaults to INDEX_PATH.
+        n_probe (int, optional): buckets scanned per query. Defaults to
+            N_PROBE_FRACTION of the buckets, at least N_PROBE.
+
+    Returns:
+        IVF_Index: index bound to `matrix`
+    """
+    return _load_index(matrix, version, path, n_probe)
+
+
+@st.cache_resource(max_entries=1)
+def _load_index(_matrix, version, path, n_probe):
+    index = IVF_Index.load(_matrix, path, n_probe)
+    if index is None:
+        index = IVF_Index.build(_matrix, n_probe=n_probe)
+        index.save(path)
+    return index
+
+
+def _top_k(dist, k):
+    k = min(k, len(dist))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(dist, k - 1)[:k]
+    return top[np.argsort(dist[top], kind='stable')]
+
+
+def _nearest_centroid(matrix, centroids, block_size=65536):
+    # argmin ||x - c||^2 == argmin (||c||^2 - 2 x.c)
+    centroid_norms = np.sum(centroids**2, axis=1)
+    assign = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), block_size):
+        block = matrix[start:start + block_size]
+        assign[start:start + block_size] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+    return assign
+
+
+def _kmeans(sample, n_list, n_iter, rng):
+    centroids = sample[rng.choice(len(sample), n_list, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _nearest_centroid(sample, centroids)
+        order = np.argsort(assign, kind='stable')
+        ids, starts = np.unique(assign[order], return_index=True)
+        counts = np.diff(np.append(starts, len(order)))
+        # empty buckets keep their previous centroid
+        centroids[ids] = np.add.reduceat(sample[order], starts, axis=0) / counts[:, None]
+    return centroids
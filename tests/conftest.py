@@ -0,0 +1,25 @@
+import pytest
+
+import db
+from db import Query_Cache, Query_Log, SQLite_Backend, set_backend
+from fixtures import load_synthetic_catalog
+
+
+@pytest.fixture
+def sqlite_backend(monkeypatch):
+    """ In-memory SQLite backend with a fresh query cache and log, so tests
+    need neither Postgres nor secrets.toml
+    """
+    query_cache, query_log = Query_Cache(), Query_Log()
+    monkeypatch.setattr(db, 'init_query_cache', lambda: query_cache)
+    monkeypatch.setattr(db, 'init_query_log', lambda: query_log)
+    backend = SQLite_Backend()
+    set_backend(backend)
+    yield backend
+    set_backend(None)
+
+
+@pytest.fixture
+def synthetic_catalog(sqlite_backend):
+    """ Small synthetic wines and users tables, see fixtures.py """
+    return load_synthetic_catalog(n_wines=250, n_users=20, dim=8)
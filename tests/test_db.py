@@ -0,0 +1,397 @@
+import base64
+import threading
+
+import numpy as np
+import pandas as pd
+import psycopg2
+import psycopg2.pool
+import pytest
+
+import db
+from db import (Connection_Pool, Query_Cache, Write_Behind, _copy_field, decode_column, decode_vector, decode_vectors, encode_vector,
+                encode_vectors, insert_table, iter_table, run_statement, select_table, update_table, update_rows, write_table)
+from fixtures import USERS_SCHEMA, synthetic_users, synthetic_wines
+
+
+def special_matrix(dim=16):
+    """ Rows of every float32 edge case followed by random bit patterns, so
+    NaN payloads and denormals go through the codecs too
+    """
+    special = np.array([0.0, -0.0, np.inf, -np.inf, np.nan, 1e-45, -1e-45, 1.1754942e-38,
+                        np.finfo(np.float32).max, np.finfo(np.float32).min, 1.0, -1.0], dtype=np.float32)
+    rows = np.resize(special, (4, dim))
+    bits = np.random.default_rng(0).integers(0, 2**32, size=(60, dim), dtype=np.uint64).astype(np.uint32)
+    # all-zero and all-one words are the ends of the base85 range
+    bits[0], bits[1] = 0, 0xFFFFFFFF
+    return np.concatenate([rows, bits.view(np.float32)])
+
+
+def assert_bit_equal(actual, expected):
+    assert actual.dtype == np.float32 and actual.shape == expected.shape
+    assert np.array_equal(actual.view(np.uint32), expected.view(np.uint32))
+
+
+def test_encode_vectors_matches_encode_vector():
+    matrix = special_matrix()
+    assert encode_vectors(matrix) == [encode_vector(row) for row in matrix]
+
+
+def test_encode_vector_is_base64_b85():
+    matrix = special_matrix()
+    assert encode_vectors(matrix) == [base64.b85encode(row.tobytes()).decode() for row in matrix]
+
+
+def test_encode_vectors_single_vector():
+    vector = special_matrix()[0]
+    assert encode_vectors(vector) == [encode_vector(vector)]
+
+
+def test_decode_vectors_round_trip():
+    matrix = special_matrix()
+    assert_bit_equal(decode_vectors(encode_vectors(matrix)), matrix)
+
+
+def test_decode_vectors_matches_decode_vector():
+    matrix = special_matrix()
+    serialized = [encode_vector(row) for row in matrix]
+    assert_bit_equal(decode_vectors(serialized), np.stack([decode_vector(string) for string in serialized]))
+
+
+def test_binary_round_trip_with_memoryview():
+    matrix = special_matrix()
+    serialized = encode_vectors(matrix, codec='binary')
+    assert all(len(value) == matrix.shape[1] * 4 for value in serialized)
+    # psycopg2 returns bytea as memoryview
+    assert_bit_equal(decode_vectors([memoryview(value) for value in serialized]), matrix)
+    assert_bit_equal(decode_vectors(serialized, codec='binary'), matrix)
+
+
+def test_decode_vectors_empty():
+    assert decode_vectors([]).shape == (0, 0)
+
+
+def test_decode_vectors_rejects_bad_input():
+    serialized = encode_vectors(special_matrix())
+    with pytest.raises(ValueError):
+        decode_vectors([serialized[0], serialized[1][:-5]])
+    with pytest.raises(ValueError):
+        decode_vectors([serialized[0][:-1] + '"'])
+    with pytest.raises(ValueError):
+        # '~~~~~' is above 2**32 - 1
+        decode_vectors(['~~~~~'])
+    with pytest.raises(ValueError):
+        decode_vectors(serialized, codec='hex')
+
+
+def test_decode_column_keeps_nulls():
+    matrix = special_matrix()[:5]
+    serialized = encode_vectors(matrix)
+    column = pd.Series([serialized[0], None, serialized[1], serialized[2], None, serialized[3], serialized[4]])
+
+    decoded = decode_column(column)
+    assert len(decoded) == len(column)
+    assert decoded[1] is None and decoded[4] is None
+    for row, vector in zip([0, 2, 3, 5, 6], matrix):
+        assert_bit_equal(decoded[row], vector)
+
+
+def test_decode_column_without_nulls():
+    matrix = special_matrix()
+    decoded = decode_column(pd.Series(encode_vectors(matrix)))
+    assert_bit_equal(np.stack(decoded), matrix)
+
+
+def test_decode_column_all_nulls():
+    assert decode_column(pd.Series([None, None], dtype=object)) == [None, None]
+
+
+def test_write_behind_retries_failing_group_and_dead_letters_it(monkeypatch):
+    written = []
+
+    def update_rows(table_name, rows, key, batch_size):
+        if any('bad' in row for row in rows):
+            raise ValueError('boom')
+        written.extend(rows)
+        return len(rows)
+
+    monkeypatch.setattr(db, 'update_rows', update_rows)
+    writer = Write_Behind('users', 'user_name', flush_interval=3600, max_attempts=2)
+    try:
+        writer.put('a', {'good': 1})
+        writer.put('b', {'bad': 1})
+        assert writer.flush() == 1
+        assert written == [{'user_name': 'a', 'good': 1}]
+        assert writer.pending('b') == {'bad': 1} and writer.pending('a') is None
+
+        assert writer.flush() == 0
+        stats = writer.stats()
+        assert stats['pending'] == 0 and stats['dead_lettered'] == 1
+        assert stats['dead_letters'][0]['key'] == 'b' and stats['dead_letters'][0]['attempts'] == 2
+        assert writer.flush() == 0
+    finally:
+        writer.close()
+
+
+def test_copy_field_encodes_null_bytes_and_quotes():
+    assert _copy_field(None) == ''
+    assert _copy_field('') == '""'
+    assert _copy_field('a "b", c') == '"a ""b"", c"'
+    assert _copy_field(b'\x00\xff') == '"\\x00ff"'
+    assert _copy_field(memoryview(b'xy')) == '"\\x7879"'
+    assert _copy_field(np.float32(2.5)) == '"2.5"'
+    assert _copy_field(pd.Timestamp('2020-01-02 03:04:05')) == '"2020-01-02T03:04:05"'
+    with pytest.raises(TypeError):
+        _copy_field({'a': 1})
+
+
+class Fake_Connection:
+    """ Connection double for Connection_Pool: commits, rolls back and pings
+    until it is broken
+    """
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.status = psycopg2.extensions.STATUS_READY
+        self.commits = self.rollbacks = 0
+
+    def cursor(self):
+        conn = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def execute(self, query):
+                if conn.broken:
+                    raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+        return Cursor()
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+def fake_pool(**kwargs):
+    connections = []
+
+    def connect():
+        connections.append(Fake_Connection())
+        return connections[-1]
+
+    return Connection_Pool(connect, **kwargs), connections
+
+
+def test_pool_reuses_connections_up_to_max_size():
+    pool, connections = fake_pool(min_size=1, max_size=2, timeout=0.05)
+    first = pool.getconn()
+    second = pool.getconn()
+    assert connections == [first, second]
+    with pytest.raises(psycopg2.pool.PoolError):
+        pool.getconn()
+    assert pool.stats()['timeouts'] == 1
+
+    pool.putconn(first)
+    assert pool.getconn() is first
+    assert len(connections) == 2 and pool.stats()['in_use'] == 2
+
+
+def test_pool_waiting_checkout_gets_returned_connection():
+    pool, _ = fake_pool(min_size=1, max_size=1, timeout=5)
+    conn = pool.getconn()
+    threading.Timer(0.05, pool.putconn, [conn]).start()
+    assert pool.getconn() is conn
+    assert pool.stats()['waits'] == 1
+
+
+def test_pool_connection_commits_or_rolls_back():
+    pool, connections = fake_pool(min_size=1)
+    with pool.connection():
+        pass
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError
+    assert (connections[0].commits, connections[0].rollbacks) == (1, 1)
+    assert len(connections) == 1 and pool.stats()['idle'] == 1
+
+
+def test_pool_discards_connection_broken_during_query():
+    pool, connections = fake_pool(min_size=2, max_size=2, health_check_interval=3600)
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            conn.broken = True
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+    assert conn.closed and pool.stats()['size'] == 1
+
+    # the server may have restarted, so the idle connection is pinged before reuse
+    connections[0].broken = True
+    replacement = pool.getconn()
+    assert replacement not in connections[:2] and connections[0].closed
+    assert pool.stats()['reconnects'] == 1
+
+
+def test_pool_replaces_idle_connection_failing_its_ping():
+    pool, connections = fake_pool(min_size=1, health_check_interval=0)
+    connections[0].broken = True
+    conn = pool.getconn()
+    assert conn is connections[1] and connections[0].closed
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+
+
+def test_iter_table_chunks_match_select_table(synthetic_catalog):
+    chunks = list(iter_table('wines', ['wine_name', 'country', 'embeddings'], order_by='wine_name', chunk_size=100))
+    assert [len(chunk) for chunk in chunks] == [100, 100, 50]
+
+    streamed = pd.concat(chunks, ignore_index=True)
+    selected = select_table('wines', ['wine_name', 'country', 'embeddings'], order_by='wine_name')
+    pd.testing.assert_frame_equal(streamed.drop(columns='embeddings'), selected.drop(columns='embeddings'))
+    assert_bit_equal(np.stack(streamed['embeddings']), np.stack(selected['embeddings']))
+
+
+def test_iter_table_as_numpy(synthetic_catalog):
+    wines, _ = synthetic_catalog
+    chunks = list(iter_table('wines', ['wine_name', 'embeddings'], order_by='wine_name', chunk_size=128, as_numpy=True))
+    assert [len(chunk['wine_name']) for chunk in chunks] == [128, 122]
+    assert chunks[0]['embeddings'].shape == (128, 8)
+    assert_bit_equal(np.concatenate([chunk['embeddings'] for chunk in chunks]), np.stack(wines['embeddings']))
+
+
+def test_iter_table_where_and_early_close(synthetic_catalog):
+    wines, _ = synthetic_catalog
+    country = wines['country'][0]
+    chunks = iter_table('wines', ['country'], where_dict={'country': country}, chunk_size=10)
+    first = next(chunks)
+    assert len(first) == min(10, (wines['country'] == country).sum()) and set(first['country']) == {country}
+    chunks.close()
+
+    # the connection went back to the backend, and the scan is logged without an error
+    assert len(select_table('wines', ['wine_name'])) == len(wines)
+    report = db.init_query_log().report()
+    scan = report[report['template'].str.contains('WHERE country')].iloc[0]
+    assert scan['errors'] == 0 and scan['rows'] == len(first)
+
+
+def test_iter_table_empty(synthetic_catalog):
+    assert list(iter_table('wines', where_dict={'country': 'Atlantis'})) == []
+
+
+@pytest.fixture
+def users(sqlite_backend):
+    run_statement(USERS_SCHEMA.format(table_name='users'))
+    return synthetic_users(synthetic_wines(50, dim=8), 30)
+
+
+def read_users():
+    return select_table('users', order_by='user_name').set_index('user_name')
+
+
+def assert_users_equal(read, expected):
+    expected = expected.set_index('user_name').loc[read.index]
+    pd.testing.assert_frame_equal(read.drop(columns='embeddings'), expected.drop(columns='embeddings'),
+                                  check_dtype=False)
+    assert_bit_equal(np.stack(read['embeddings']), np.stack(expected['embeddings']))
+
+
+@pytest.mark.parametrize('method', ['values', 'copy'])
+def test_write_table_inserts_every_row(users, method):
+    assert write_table('users', users, batch_size=7, method=method) == len(users)
+    read = read_users()
+    assert len(read) == len(users)
+    assert_users_equal(read, users)
+
+
+@pytest.mark.parametrize('method', ['values', 'copy'])
+def test_write_table_upsert(users, method):
+    write_table('users', users[:20], method=method)
+    changed = users[10:].assign(address='changed')
+    # a key repeated within a batch keeps its last row
+    repeated = pd.concat([users[25:26].assign(address='first'), changed], ignore_index=True)
+    write_table('users', repeated, batch_size=100, on_conflict=['user_name'], method=method)
+
+    read = read_users()
+    assert len(read) == len(users)
+    assert_users_equal(read, pd.concat([users[:10], changed], ignore_index=True))
+
+
+def test_write_table_rejects_unknown_method(users):
+    with pytest.raises(ValueError):
+        write_table('users', users, method='csv')
+
+
+def test_update_rows(users):
+    write_table('users', users)
+    rng = np.random.default_rng(1)
+    updates = pd.DataFrame({
+        'user_name': list(users['user_name'][:12]) + ['no such user'],
+        'address': 'moved',
+        'embeddings': list(rng.standard_normal((13, 8)).astype(np.float32)),
+    })
+    assert update_rows('users', updates, 'user_name', batch_size=5) == 12
+
+    expected = users.copy()
+    expected.loc[:11, 'address'] = 'moved'
+    expected['embeddings'] = list(updates['embeddings'][:12]) + list(users['embeddings'][12:])
+    assert_users_equal(read_users(), expected)
+
+
+def test_query_cache_serves_hits_until_insert_table(users):
+    write_table('users', users[:5])
+    cache = db.init_query_cache()
+    assert len(select_table('users', ['user_name'], cached=True)) == 5
+    assert len(select_table('users', ['user_name'], cached=True)) == 5
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 1)
+
+    row = users.iloc[5].to_dict()
+    row['embeddings'] = encode_vector(row['embeddings'])
+    insert_table('users', row)
+    assert cache.stats()['invalidations'] == 1
+    assert len(select_table('users', ['user_name'], cached=True)) == 6
+
+
+def test_query_cache_invalidated_by_update_table(users):
+    write_table('users', users[:5])
+    where_dict = {'user_name': users['user_name'][0]}
+    assert select_table('users', ['address'], where_dict, cached=True)['address'][0] != 'moved'
+    update_table('users', {'address': 'moved'}, where_dict)
+    assert select_table('users', ['address'], where_dict, cached=True)['address'][0] == 'moved'
+
+
+def test_query_cache_keeps_tables_apart(users):
+    write_table('users', users[:5])
+    cache = db.init_query_cache()
+    select_table('users', ['user_name'], cached=True)
+    cache.invalidate('wines')
+    select_table('users', ['user_name'], cached=True)
+    assert cache.stats()['hits'] == 1
+
+
+def test_query_cache_skips_result_computed_during_a_write():
+    cache = Query_Cache()
+
+    def run():
+        cache.invalidate('users')
+        return pd.DataFrame({'user_name': ['stale']})
+
+    cache.cached("SELECT user_name FROM users", [], ['users'], run)
+    assert cache.stats()['entries'] == 0
+
+
+def test_query_cache_evicts_least_recently_used():
+    result = pd.DataFrame({'value': np.arange(100)})
+    cache = Query_Cache(max_bytes=2 * db._result_size(result))
+    for query in ['SELECT 1', 'SELECT 2', 'SELECT 1', 'SELECT 3']:
+        cache.cached(query, [], ['t'], lambda: result)
+    cache.cached('SELECT 1', [], ['t'], lambda: result)
+    stats = cache.stats()
+    assert stats['entries'] == 2 and stats['evictions'] == 1 and stats['hits'] == 2
@@ -0,0 +1,62 @@
+import numpy as np
+
+from markets import Market_Index, haversine_km
+
+
+def random_markets(n_markets=2000, seed=0):
+    """ Markets spread over a city, with a few far away ones """
+    rng = np.random.default_rng(seed)
+    lat = 35.18 + rng.normal(scale=0.1, size=n_markets)
+    lon = 126.9 + rng.normal(scale=0.1, size=n_markets)
+    lat[:10] = rng.uniform(-60, 60, 10)
+    lon[:10] = rng.uniform(-180, 180, 10)
+    return lat, lon
+
+
+def brute_force(lat, lon, lats, lons):
+    distances = haversine_km(lat, lon, lats, lons)
+    order = np.argsort(distances, kind='stable')
+    return order, distances[order]
+
+
+def test_within_matches_brute_force():
+    lats, lons = random_markets()
+    index = Market_Index(lats, lons, cell_km=1.0)
+    for lat, lon in [(35.18, 126.9), (35.3, 127.0), (lats[0], lons[0])]:
+        order, distances = brute_force(lat, lon, lats, lons)
+        for radius_km in [0.5, 3.0, 25.0]:
+            indices, within = index.within(lat, lon, radius_km)
+            inside = distances <= radius_km
+            np.testing.assert_array_equal(indices, order[inside])
+            np.testing.assert_allclose(within, distances[inside])
+
+
+def test_nearest_matches_brute_force():
+    lats, lons = random_markets()
+    index = Market_Index(lats, lons, cell_km=2.0)
+    for lat, lon in [(35.18, 126.9), (35.3, 127.0), (0.0, 0.0), (lats[3], lons[3])]:
+        order, distances = brute_force(lat, lon, lats, lons)
+        for k in [1, 5, 50]:
+            indices, nearest = index.nearest(lat, lon, k)
+            np.testing.assert_array_equal(indices, order[:k])
+            np.testing.assert_allclose(nearest, distances[:k])
+
+
+def test_nearest_k_above_market_count():
+    lats, lons = random_markets(20)
+    indices, _ = Market_Index(lats, lons).nearest(35.18, 126.9, k=50)
+    assert sorted(indices) == list(range(20))
+
+
+def test_in_box_matches_brute_force():
+    lats, lons = random_markets()
+    index = Market_Index(lats, lons)
+    south, west, north, east = 35.1, 126.8, 35.25, 127.05
+    inside = (lats >= south) & (lats <= north) & (lons >= west) & (lons <= east)
+    np.testing.assert_array_equal(index.in_box(south, west, north, east), np.flatnonzero(inside))
+
+
+def test_empty_index():
+    index = Market_Index([], [])
+    assert len(index.within(35.18, 126.9, 5.0)[0]) == 0
+    assert len(index.nearest(35.18, 126.9, 5)[0]) == 0
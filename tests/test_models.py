@@ -0,0 +1,88 @@
+import torch
+
+from models import build_model
+
+
+def loop_grapes(model, y_grape, grapes, grapes_scales):
+    """ get_grapes before the masked gather, one row at a time """
+    embedding_matrix = model.encoder.embedding.grapes_embedding.weight.clone()
+    pred_y = torch.matmul(y_grape, embedding_matrix.T)
+    final_pred_y, true_y = [], []
+    for i in range(pred_y.shape[0]):
+        final_pred_y.append(pred_y[i][grapes[i][grapes[i] != 0]])
+        true_y.append(grapes_scales[i][grapes_scales[i] != 0])
+    return model.sig(torch.cat(final_pred_y)), torch.cat(true_y)
+
+
+def loop_aromas(model, y_aromas, aromas, aromas_scales):
+    """ get_aromas before the masked gather, one row at a time """
+    embedding_matrix = model.encoder.embedding.aroma_embedding.weight.clone()
+    pred_y = torch.matmul(y_aromas, embedding_matrix.T)
+    final_pred_y, true_y = [], []
+    for i in range(pred_y.shape[0]):
+        aromas_id = aromas[i][aromas_scales[i] != 0]
+        final_pred_y.append(pred_y[i][aromas_id])
+        true_y.append(aromas_scales[i][aromas_id])
+    return model.sig(torch.cat(final_pred_y)), torch.cat(true_y)
+
+
+def make_batch(model, batch_size=64, max_grapes=8, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    embedding = model.encoder.embedding
+    embed_size = embedding.grapes_embedding.embedding_dim
+
+    # grape ids padded with 0, scales non-zero where the ids are
+    n_grapes = torch.randint(1, max_grapes + 1, (batch_size, 1), generator=generator)
+    present = torch.arange(max_grapes) < n_grapes
+    grapes = torch.randint(1, embedding.grapes_size, (batch_size, max_grapes), generator=generator) * present
+    grapes_scales = torch.rand(batch_size, max_grapes, generator=generator) * present
+
+    # every aroma id in a shuffled order per row, some with a zero scale
+    aromas = torch.stack([torch.randperm(embedding.aroma_size, generator=generator) for _ in range(batch_size)])
+    aromas_scales = torch.rand(batch_size, embedding.aroma_size, generator=generator)
+    aromas_scales[torch.rand(batch_size, embedding.aroma_size, generator=generator) < 0.4] = 0
+
+    y_grape = torch.randn(batch_size, embed_size, generator=generator)
+    y_aromas = torch.randn(batch_size, embed_size, generator=generator)
+    return y_grape, grapes, grapes_scales, y_aromas, aromas, aromas_scales
+
+
+def test_get_grapes_matches_row_loop():
+    torch.manual_seed(0)
+    model = build_model()
+    y_grape, grapes, grapes_scales, _, _, _ = make_batch(model)
+
+    pred, true = model.get_grapes(y_grape, grapes, grapes_scales)
+    expected_pred, expected_true = loop_grapes(model, y_grape, grapes, grapes_scales)
+    assert torch.equal(pred, expected_pred)
+    assert torch.equal(true, expected_true)
+
+
+def test_get_aromas_matches_row_loop():
+    torch.manual_seed(0)
+    model = build_model()
+    _, _, _, y_aromas, aromas, aromas_scales = make_batch(model)
+
+    pred, true = model.get_aromas(y_aromas, aromas, aromas_scales)
+    expected_pred, expected_true = loop_aromas(model, y_aromas, aromas, aromas_scales)
+    assert torch.equal(pred, expected_pred)
+    assert torch.equal(true, expected_true)
+
+
+def test_gathers_match_row_loop_gradients():
+    torch.manual_seed(0)
+    model = build_model()
+    y_grape, grapes, grapes_scales, y_aromas, aromas, aromas_scales = make_batch(model)
+
+    def gradients(get_grapes, get_aromas):
+        model.zero_grad()
+        grape_pred, _ = get_grapes(y_grape, grapes, grapes_scales)
+        aroma_pred, _ = get_aromas(y_aromas, aromas, aromas_scales)
+        (grape_pred.sum() + aroma_pred.sum()).backward()
+        embedding = model.encoder.embedding
+        return embedding.grapes_embedding.weight.grad.clone(), embedding.aroma_embedding.weight.grad.clone()
+
+    gathered = gradients(model.get_grapes, model.get_aromas)
+    looped = gradients(lambda *args: loop_grapes(model, *args), lambda *args: loop_aromas(model, *args))
+    for gathered_grad, looped_grad in zip(gathered, looped):
+        assert torch.allclose(gathered_grad, looped_grad)
@@ -0,0 +1,87 @@
+import numpy as np
+
+from recommend import IVF_Index, recommend_batch, recommend_top_k, squared_norms
+
+
+def random_catalog(n_wines=500, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((n_wines, dim)).astype(np.float32)
+
+
+def clustered_catalog(n_wines=5000, n_clusters=64, dim=16, seed=0):
+    """ Rows around random cluster centers, the shape IVF buckets are built for """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)) * 4
+    return (centers[rng.integers(0, n_clusters, n_wines)] + rng.standard_normal((n_wines, dim))).astype(np.float32)
+
+
+def test_recommend_batch_matches_recommend_top_k():
+    matrix = random_catalog()
+    users = random_catalog(37, seed=1)
+    norms = squared_norms(matrix)
+    # a bound of a few users per block exercises the blocking
+    indices, distances = recommend_batch(matrix, users, k=20, norms=norms, max_bytes=12 * len(matrix) * 5)
+    assert indices.shape == distances.shape == (len(users), 20)
+    for user, user_indices, user_distances in zip(users, indices, distances):
+        top, dist = recommend_top_k(matrix, user, k=20, norms=norms)
+        np.testing.assert_array_equal(user_indices, top)
+        np.testing.assert_allclose(user_distances, dist, rtol=1e-5, atol=1e-5)
+
+
+def test_recommend_batch_k_above_catalog_size():
+    matrix = random_catalog(5)
+    indices, distances = recommend_batch(matrix, random_catalog(3, seed=1), k=200)
+    assert indices.shape == (3, 5)
+    assert all(sorted(row) == list(range(5)) for row in indices)
+    assert np.all(np.diff(distances, axis=1) >= 0)
+
+
+def test_recommend_batch_empty_catalog():
+    indices, distances = recommend_batch(np.zeros((0, 16), dtype=np.float32), random_catalog(3, seed=1), k=200)
+    assert indices.shape == distances.shape == (3, 0)
+
+
+def test_ivf_search_recall_against_exact_top_k():
+    matrix = clustered_catalog()
+    index = IVF_Index.build(matrix, n_list=64)
+    queries = matrix[np.random.default_rng(1).integers(0, len(matrix), 50)]
+
+    recalls = []
+    for vec in queries:
+        exact, _ = recommend_top_k(matrix, vec, k=10)
+        found, distances = index.search(vec, k=10)
+        assert len(found) == 10 and np.all(np.diff(distances) >= 0)
+        recalls.append(len(set(found) & set(exact)) / 10)
+    assert np.mean(recalls) >= 0.9
+
+
+def test_ivf_search_probing_every_bucket_is_exact():
+    matrix = clustered_catalog()
+    index = IVF_Index.build(matrix, n_list=64)
+    for vec in matrix[:5]:
+        exact, exact_distances = recommend_top_k(matrix, vec, k=50)
+        # the default n_probe for k=200 reaches a quarter of the buckets, an exact scan
+        for k, n_probe in [(50, index.n_list), (200, None)]:
+            found, distances = index.search(vec, k=k, n_probe=n_probe)
+            np.testing.assert_array_equal(found[:50], exact)
+            np.testing.assert_allclose(distances[:50], exact_distances, rtol=1e-5, atol=1e-5)
+
+
+def test_ivf_search_small_catalog():
+    matrix = random_catalog(30)
+    index = IVF_Index.build(matrix)
+    found, _ = index.search(matrix[0], k=200)
+    assert index.n_list == 1 and sorted(found) == list(range(30))
+
+
+def test_ivf_save_and_load(tmp_path):
+    matrix = clustered_catalog(n_wines=2000)
+    index = IVF_Index.build(matrix, n_list=32)
+    path = str(tmp_path / 'index.npz')
+    index.save(path)
+
+    loaded = IVF_Index.load(matrix, path)
+    vec = matrix[0]
+    np.testing.assert_array_equal(loaded.search(vec, k=10, n_probe=2)[0], index.search(vec, k=10, n_probe=2)[0])
+    changed = matrix.copy()
+    changed[-1, -1] += 1
+    assert IVF_Index.load(changed, path) is None